@@ -26,6 +26,25 @@ def create_app(url_prefix: str = ""):
     app.register_blueprint(webhook_blueprint)
     app.register_blueprint(history_blueprint, url_prefix=url_prefix)
 
+    if app.config.get("RAG_PRELOAD_VAULT"):
+        from app.services.rag_ollama_whatsapp import preload_vault
+
+        preload_vault()
+
+    if app.config.get("RAG_WARM_SYSTEM_PROMPT"):
+        from threading import Thread
+
+        from app.services.rag_ollama_whatsapp import warm_system_prompt
+        from app.utils.whatsapp_utils import warm_routing_classifier
+
+        def warm_models():
+            warm_routing_classifier(app)
+            # Last, so the generation prompt is the one left in Ollama's prompt cache.
+            warm_system_prompt()
+
+        # In the background: loading the model can take a while and must not delay startup.
+        Thread(target=warm_models, daemon=True, name="rag-warmup").start()
+
     worker_count = app.config.get("WHATSAPP_WORKERS", 1)
     start_whatsapp_workers(app, worker_count)
 
@@ -28,6 +28,12 @@ def load_configurations(app):
         max_age = 0
     app.config["WHATSAPP_MAX_MESSAGE_AGE_SECONDS"] = max(0, max_age)
 
+    preload_raw = os.getenv("RAG_PRELOAD_VAULT", "").strip().lower()
+    app.config["RAG_PRELOAD_VAULT"] = preload_raw in {"1", "true", "yes"}
+
+    warm_raw = os.getenv("RAG_WARM_SYSTEM_PROMPT", "").strip().lower()
+    app.config["RAG_WARM_SYSTEM_PROMPT"] = warm_raw in {"1", "true", "yes"}
+
 
 def configure_logging():
     level_name = os.getenv("LOG_LEVEL", "INFO").upper()
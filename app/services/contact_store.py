@@ -1,18 +1,34 @@
-import json
 import logging
+import os
 import re
 import threading
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from typing import Any, Dict, Tuple
 
+from app.utils import fast_json
+
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 CONTACT_STORE_PATH = PROJECT_ROOT / "threads_db_store" / "contacts.json"
+# Append-only JSONL journal of contact upserts, folded into contacts.json on compaction.
+CONTACT_JOURNAL_PATH = CONTACT_STORE_PATH.with_name("contacts.log")
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+JOURNAL_COMPACT_LINES = 500
 
 WIB = timezone(timedelta(hours=7))
 
 DEFAULT_UNKNOWN_CATEGORY = "external_unknown"
+# _STORE_LOCK guards loading, journal appends, and compaction. Per-contact
+# read-modify-write cycles are serialized by a striped lock instead, so
+# updates for different numbers only meet on the short journal append.
 _STORE_LOCK = threading.Lock()
+_KEY_LOCK_STRIPES = 64
+_KEY_LOCKS = tuple(threading.Lock() for _ in range(_KEY_LOCK_STRIPES))
+# Parsed store keyed by the (st_mtime_ns, st_size) of contacts.json and contacts.log.
+# The dict is only mutated one key at a time under _STORE_LOCK, so lock-free
+# single-key reads are safe; iterate over it only while holding _STORE_LOCK.
+_STORE_CACHE: Tuple[Tuple[int, int, int, int], Dict[str, Dict[str, Any]]] | None = None
+_JOURNAL_LINES = 0
 
 
 def _now_iso() -> str:
@@ -67,29 +83,15 @@ def _candidate_contact_keys(raw: str) -> list[str]:
     if not cleaned:
         return []
 
-    lid_key = f"lid:{cleaned}"
-    keys: list[str] = []
-    prefer_lid = suffix == "lid"
-
-    if prefer_lid:
-        keys.append(lid_key)
-
-    keys.append(cleaned)
-
-    if not prefer_lid:
-        keys.append(lid_key)
-
-    seen: set[str] = set()
-    ordered: list[str] = []
-    for key in keys:
-        if key and key not in seen:
-            seen.add(key)
-            ordered.append(key)
-    return ordered
+    if suffix == "lid":
+        return [f"lid:{cleaned}", cleaned]
+    return [cleaned, f"lid:{cleaned}"]
 
 
-def _normalize_contact(payload: Dict[str, Any], *, key: str | None = None) -> Dict[str, Any]:
-    now = _now_iso()
+def _normalize_contact(
+    payload: Dict[str, Any], *, key: str | None = None, now: str | None = None
+) -> Dict[str, Any]:
+    now = now or _now_iso()
     raw_phone = payload.get("phone") or key or ""
     normalized_phone = normalize_phone(raw_phone) or str(raw_phone)
     if key:
@@ -111,52 +113,195 @@ def _ensure_store_dir() -> None:
     CONTACT_STORE_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 
-def _load_store() -> Dict[str, Dict[str, Any]]:
+def _stat_signature(path: Path) -> Tuple[int, int]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 0, 0
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _store_signature() -> Tuple[int, int, int, int]:
+    return _stat_signature(CONTACT_STORE_PATH) + _stat_signature(CONTACT_JOURNAL_PATH)
+
+
+def _apply_record(store: Dict[str, Dict[str, Any]], key: str | None, value: Any) -> None:
+    if isinstance(value, dict):
+        phone = normalize_phone(key or value.get("phone"))
+    else:
+        phone = normalize_phone(key)
+    if not phone:
+        return
+    payload = value if isinstance(value, dict) else {"phone": phone}
+    store[phone] = _normalize_contact(payload, key=phone)
+
+
+def _read_snapshot(store: Dict[str, Dict[str, Any]]) -> None:
     if not CONTACT_STORE_PATH.exists():
-        return {}
+        return
     try:
-        raw = json.loads(CONTACT_STORE_PATH.read_text(encoding="utf-8"))
-        if not isinstance(raw, dict):
-            return {}
-        normalized: Dict[str, Dict[str, Any]] = {}
-        for key, value in raw.items():
-            if isinstance(value, dict):
-                phone = normalize_phone(key or value.get("phone"))
-            else:
-                phone = normalize_phone(key)
-            if not phone:
-                continue
-            payload = value if isinstance(value, dict) else {"phone": phone}
-            normalized[phone] = _normalize_contact(payload, key=phone)
-        return normalized
+        raw = fast_json.loads(CONTACT_STORE_PATH.read_bytes())
     except Exception:
         logging.exception("Failed to read contact store from %s", CONTACT_STORE_PATH)
+        return
+    if not isinstance(raw, dict):
+        return
+    for key, value in raw.items():
+        _apply_record(store, key, value)
+
+
+def _replay_journal(store: Dict[str, Dict[str, Any]]) -> int:
+    """Apply journal records on top of the snapshot; returns the number of lines read."""
+    if not CONTACT_JOURNAL_PATH.exists():
+        return 0
+    lines = 0
+    try:
+        with CONTACT_JOURNAL_PATH.open("rb") as journal:
+            for line in journal:
+                line = line.strip()
+                if not line:
+                    continue
+                lines += 1
+                try:
+                    record = fast_json.loads(line)
+                except fast_json.JSONDecodeError:
+                    logging.warning("Skipping corrupt contact journal line in %s", CONTACT_JOURNAL_PATH)
+                    continue
+                if isinstance(record, dict):
+                    _apply_record(store, None, record)
+    except OSError:
+        logging.exception("Failed to read contact journal from %s", CONTACT_JOURNAL_PATH)
+    return lines
+
+
+def _load_store() -> Dict[str, Dict[str, Any]]:
+    """
+    Return the contact store (snapshot + journal), reusing the cached copy while both files are unchanged.
+    Callers must hold _STORE_LOCK.
+    """
+    global _STORE_CACHE, _JOURNAL_LINES
+    signature = _store_signature()
+    if signature == (0, 0, 0, 0):
+        _STORE_CACHE = None
         return {}
 
+    cached = _STORE_CACHE
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    store: Dict[str, Dict[str, Any]] = {}
+    _read_snapshot(store)
+    _JOURNAL_LINES = _replay_journal(store)
+    _STORE_CACHE = (signature, store)
+    return store
+
+
+def _write_snapshot(path: Path, store: Dict[str, Dict[str, Any]]) -> None:
+    """Stream store to path one record at a time through a 1 MiB write buffer."""
+    with open(path, "wb", buffering=1 << 20) as snapshot:
+        snapshot.write(b"{")
+        for idx, (key, record) in enumerate(store.items()):
+            if idx:
+                snapshot.write(b",")
+            snapshot.write(fast_json.dumps(key))
+            snapshot.write(b":")
+            snapshot.write(fast_json.dumps(record))
+        snapshot.write(b"}")
+
 
 def _save_store(store: Dict[str, Dict[str, Any]]) -> None:
+    """Rewrite the contacts.json snapshot from store and truncate the journal."""
+    global _STORE_CACHE, _JOURNAL_LINES
     _ensure_store_dir()
-    payload = json.dumps(store, indent=2)
     tmp_path = CONTACT_STORE_PATH.with_suffix(".json.tmp")
-    tmp_path.write_text(payload, encoding="utf-8")
+    _write_snapshot(tmp_path, store)
     try:
         tmp_path.replace(CONTACT_STORE_PATH)
     except Exception:
         logging.exception("Failed to atomically replace contact store; attempting fallback write.")
-        CONTACT_STORE_PATH.write_text(payload, encoding="utf-8")
+        _write_snapshot(CONTACT_STORE_PATH, store)
+    # The snapshot already holds every journaled record, so replaying a stale
+    # journal after a crash here is harmless.
+    try:
+        CONTACT_JOURNAL_PATH.unlink(missing_ok=True)
+    except OSError:
+        logging.exception("Failed to truncate contact journal at %s", CONTACT_JOURNAL_PATH)
+        _STORE_CACHE = None
+        return
+    _JOURNAL_LINES = 0
+    _STORE_CACHE = (_store_signature(), store)
+
+
+def _append_journal(store: Dict[str, Dict[str, Any]], key: str, contact: Dict[str, Any]) -> None:
+    """
+    Persist one upserted contact as a journal line, then publish it in store.
+    Compacts once the journal grows too large. Callers must hold _STORE_LOCK.
+    """
+    global _STORE_CACHE, _JOURNAL_LINES
+    _ensure_store_dir()
+    with CONTACT_JOURNAL_PATH.open("ab") as journal:
+        journal.write(fast_json.dumps(contact) + b"\n")
+    store[key] = contact
+    _JOURNAL_LINES += 1
+    signature = _store_signature()
+    if signature[3] >= JOURNAL_COMPACT_BYTES or _JOURNAL_LINES >= JOURNAL_COMPACT_LINES:
+        _save_store(store)
+        return
+    _STORE_CACHE = (signature, store)
+
+
+def _cached_store() -> Dict[str, Dict[str, Any]]:
+    """Return the cached store without locking when it is still current; reload otherwise."""
+    cached = _STORE_CACHE
+    if cached is not None and cached[0] == _store_signature():
+        return cached[1]
+    with _STORE_LOCK:
+        return _load_store()
+
+
+def _key_lock(candidates: list[str]) -> threading.Lock:
+    """Pick the lock stripe for a contact; lid:/plain variants of one id share a stripe."""
+    key = candidates[0]
+    if key.startswith("lid:"):
+        key = key[4:]
+    return _KEY_LOCKS[hash(key) % _KEY_LOCK_STRIPES]
+
+
+def compact_store() -> None:
+    """Fold the journal into contacts.json. Safe to call at any time."""
+    with _STORE_LOCK:
+        store = _load_store()
+        if _JOURNAL_LINES:
+            _save_store(store)
 
 
 def get_contact(phone: str) -> Dict[str, Any] | None:
     candidates = _candidate_contact_keys(phone)
     if not candidates:
         return None
-    with _STORE_LOCK:
-        store = _load_store()
-        for key in candidates:
+    store = _cached_store()
+    for key in candidates:
+        contact = store.get(key)
+        if contact:
+            # Stored records are already normalized; hand out a copy.
+            return dict(contact)
+    return None
+
+
+def get_contacts_many(phones: list[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Look up several ids against one store snapshot (a single freshness check).
+    Returns copies of the found contacts keyed by the requested id; misses are omitted.
+    """
+    store = _cached_store()
+    found: Dict[str, Dict[str, Any]] = {}
+    for phone in phones:
+        for key in _candidate_contact_keys(phone):
             contact = store.get(key)
             if contact:
-                return _normalize_contact(contact, key=key)
-        return None
+                found[phone] = dict(contact)
+                break
+    return found
 
 
 def ensure_contact_record(
@@ -173,36 +318,30 @@ def ensure_contact_record(
     if not candidates:
         return None, False
 
-    with _STORE_LOCK:
-        store = _load_store()
-        contact = None
-        normalized = ""
+    with _key_lock(candidates):
+        store = _cached_store()
         for key in candidates:
             contact = store.get(key)
             if contact:
-                normalized = key
-                break
-        created = False
-        if contact is None:
-            created = True
-            now = _now_iso()
-            normalized = normalize_phone(phone)
-            if not normalized:
-                return None, False
-            contact = {
-                "phone": normalized,
-                "category": default_category,
-                "allow_bot": bool(default_allow_bot),
-                "created_at": now,
-                "updated_at": now,
-                "source": source,
-                "routing_reason": "",
-                "routing_model": "",
-            }
-        contact = _normalize_contact(contact, key=normalized)
-        store[normalized] = contact
-        _save_store(store)
-        return contact, created
+                return dict(contact), False
+
+        now = _now_iso()
+        normalized = normalize_phone(phone)
+        if not normalized:
+            return None, False
+        contact = {
+            "phone": normalized,
+            "category": str(default_category or DEFAULT_UNKNOWN_CATEGORY),
+            "allow_bot": bool(default_allow_bot),
+            "created_at": now,
+            "updated_at": now,
+            "source": str(source or "unknown"),
+            "routing_reason": "",
+            "routing_model": "",
+        }
+        with _STORE_LOCK:
+            _append_journal(_load_store(), normalized, contact)
+        return dict(contact), True
 
 
 def upsert_contact(
@@ -218,8 +357,8 @@ def upsert_contact(
     if not candidates:
         return None
 
-    with _STORE_LOCK:
-        store = _load_store()
+    with _key_lock(candidates):
+        store = _cached_store()
         normalized = ""
         contact = None
         for key in candidates:
@@ -227,12 +366,14 @@ def upsert_contact(
             if contact:
                 normalized = key
                 break
+        now = _now_iso()
         if contact is None:
             normalized = normalize_phone(phone)
             if not normalized:
                 return None
-            contact = {"phone": normalized}
-        contact = _normalize_contact(contact, key=normalized)
+            contact = _normalize_contact({"phone": normalized}, key=normalized, now=now)
+        else:
+            contact = dict(contact)
 
         if category is not None:
             contact["category"] = str(category or DEFAULT_UNKNOWN_CATEGORY)
@@ -245,10 +386,8 @@ def upsert_contact(
         if routing_model is not None:
             contact["routing_model"] = str(routing_model)
 
-        now = _now_iso()
-        contact.setdefault("created_at", now)
         contact["updated_at"] = now
 
-        store[normalized] = contact
-        _save_store(store)
-        return contact
+        with _STORE_LOCK:
+            _append_journal(_load_store(), normalized, contact)
+        return dict(contact)
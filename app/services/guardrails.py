@@ -1,6 +1,10 @@
 import re
 import unicodedata
-from typing import Iterable, Tuple
+from functools import lru_cache, reduce
+from operator import or_
+from typing import Tuple
+
+from app.utils.pattern_set import compile_any_matcher
 
 PROMPT_INJECTION_PATTERNS = [
     re.compile(
@@ -38,34 +42,57 @@ PROMPT_INJECTION_KEYWORD_GROUPS: Tuple[Tuple[str, ...], ...] = (
     ("gunakan", "perintah", "baru"),
 )
 
+# Byte table that keeps [a-z0-9] and turns every other byte into a space.
+_GUARDRAIL_KEEP = frozenset(b"abcdefghijklmnopqrstuvwxyz0123456789")
+_GUARDRAIL_TRANS = bytes(c if c in _GUARDRAIL_KEEP else 0x20 for c in range(256))
+
+# Single-pass scan over all injection patterns (Hyperscan when installed).
+_matches_injection_pattern = compile_any_matcher(PROMPT_INJECTION_PATTERNS)
+
+# One bit per keyword; a group matches when all of its bits are present.
+_KW_VOCAB = {
+    word: 1 << idx
+    for idx, word in enumerate(
+        sorted({word for group in PROMPT_INJECTION_KEYWORD_GROUPS for word in group})
+    )
+}
+_GROUP_MASKS = tuple(
+    reduce(or_, (_KW_VOCAB[word] for word in group))
+    for group in PROMPT_INJECTION_KEYWORD_GROUPS
+)
+
 
 def normalize_guardrail_text(text: str) -> str:
     """Lowercase text, strip diacritics, and keep only alphanumerics for guardrail checks."""
     normalized = unicodedata.normalize("NFKD", text or "")
-    ascii_only = normalized.encode("ascii", "ignore").decode("ascii", "ignore")
-    lowered = ascii_only.lower()
-    cleaned = re.sub(r"[^a-z0-9\s]", " ", lowered)
-    return re.sub(r"\s+", " ", cleaned).strip()
+    ascii_only = normalized.encode("ascii", "ignore").lower()
+    cleaned = ascii_only.translate(_GUARDRAIL_TRANS)
+    return b" ".join(cleaned.split()).decode("ascii")
 
 
-def _contains_keywords(normalized_text: str, keywords: Iterable[str]) -> bool:
-    return all(keyword in normalized_text for keyword in keywords)
+@lru_cache(maxsize=4096)
+def _token_mask(token: str) -> int:
+    """Bits of every keyword contained in token (substring match, like the old `in` scan)."""
+    mask = 0
+    for word, bit in _KW_VOCAB.items():
+        if word in token:
+            mask |= bit
+    return mask
 
 
 def contains_prompt_injection_attempt(text: str) -> bool:
     """Detect prompt-injection attempts, even if the attacker uses another language."""
     if not text:
         return False
-    for pattern in PROMPT_INJECTION_PATTERNS:
-        if pattern.search(text):
-            return True
+    if _matches_injection_pattern(text):
+        return True
     normalized = normalize_guardrail_text(text)
     if not normalized:
         return False
-    return any(
-        _contains_keywords(normalized, keywords)
-        for keywords in PROMPT_INJECTION_KEYWORD_GROUPS
-    )
+    present = 0
+    for token in normalized.split():
+        present |= _token_mask(token)
+    return any((present & mask) == mask for mask in _GROUP_MASKS)
 
 
 def prompt_injection_response() -> str:
@@ -1,26 +1,38 @@
-﻿import hashlib
+﻿from __future__ import annotations
+
+import hashlib
+import atexit
 import os
 import inspect
 import json
 import logging
 import re
-import shelve
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache
 from pathlib import Path
+from queue import Empty, Queue
 from textwrap import dedent
-from typing import Any, Dict, List, Tuple
-from threading import Lock
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+from threading import Lock, Thread
 
-import torch
-import torch.nn.functional as F
-import ollama
 from app.services.guardrails import (
     contains_prompt_injection_attempt,
     prompt_injection_response,
 )
+from app.services import thread_store
 from app.services.contact_store import get_contact, upsert_contact
+from app.utils import fast_json
+from app.utils.pattern_set import compile_any_matcher
+
+# torch, numpy, and ollama are imported inside the functions that need them so
+# importing this module (e.g. from the dashboard) stays cheap.
+if TYPE_CHECKING:
+    import torch
 
-DEVICE = torch.device("cpu")
 WIB = timezone(timedelta(hours=7))
 
 # =========================
@@ -38,16 +50,17 @@ RESET_COLOR = "\033[0m"
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 DATA_DIR = PROJECT_ROOT / ".cache"
 EMBED_CACHE_DIR = DATA_DIR / "embeddings"
+EMBED_VECTOR_CACHE_DIR = EMBED_CACHE_DIR / "vectors"
 
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 EMBED_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+EMBED_VECTOR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 
 # =========================
 # Defaults / Config
 # =========================
 DEFAULT_VAULT = str(DATA_DIR / "vault.txt")
-THREADS_DB_PATH = str(PROJECT_ROOT / "threads_db_store" / "threads_db")
 DEFAULT_EMBED_MODEL = "mxbai-embed-large:latest"
 DEFAULT_GEN_MODEL = "deepseek-r1:latest"
 
@@ -58,11 +71,55 @@ DEFAULT_GEN_TEMPERATURE = float("0.15")
 DEFAULT_GEN_REPEAT_PENALTY = float("1.20")
 
 DEFAULT_NUM_CTX = int("16384")
+# How long Ollama keeps a model loaded after a request ("30m", "-1" = forever, seconds as
+# an int). Concurrent requests are batched by the server (OLLAMA_NUM_PARALLEL) only while
+# the model stays resident. Empty leaves the server default.
+_OLLAMA_KEEP_ALIVE_RAW = os.getenv("RAG_OLLAMA_KEEP_ALIVE", "").strip()
+DEFAULT_OLLAMA_KEEP_ALIVE: str | int | None = (
+    int(_OLLAMA_KEEP_ALIVE_RAW)
+    if _OLLAMA_KEEP_ALIVE_RAW.lstrip("-").isdigit()
+    else _OLLAMA_KEEP_ALIVE_RAW or None
+)
+# The classifiers share DEFAULT_GEN_MODEL with generation. Ollama reloads a model whenever
+# num_ctx changes, which also throws away its cached prompt prefix, so both default to
+# the same context size.
+DEFAULT_CLASSIFIER_NUM_CTX = int(os.getenv("RAG_CLASSIFIER_NUM_CTX", str(DEFAULT_NUM_CTX)))
 DEFAULT_MIN_MSG_LENGTH = int("20")
 DEFAULT_MAX_MSG_LENGTH = int("2048")
 DEFAULT_MAX_HISTORY_TURNS = int("12")
 DEFAULT_MODEL_HISTORY_WINDOW = int("5")
 DEFAULT_MAX_SEEN_IDS = int(os.getenv("WHATSAPP_MAX_SEEN_IDS", "500"))
+# Texts per /api/embed request; smaller batches suit Ollama servers running on CPU or MPS.
+DEFAULT_EMBED_BATCH_SIZE = max(1, int(os.getenv("RAG_EMBED_BATCH_SIZE", "128")))
+# /api/embed batches sent concurrently while building the vault cache.
+DEFAULT_EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "4"))
+# Keep vault embeddings as int8 rows with a per-row scale (4x smaller than float32).
+DEFAULT_QUANTIZE_VAULT = os.getenv("RAG_QUANTIZE_VAULT_INT8", "").strip().lower() in {
+    "1",
+    "true",
+    "yes",
+}
+# int8 vault rows upcast to float32 at a time while scoring a query, so a query never
+# holds a float32 copy of the whole vault.
+DEFAULT_INT8_SCORE_CHUNK_ROWS = max(1, int(os.getenv("RAG_INT8_SCORE_CHUNK_ROWS", "4096")))
+# Retrieval device ("cpu", "cuda", "cuda:1", ...) and storage dtype of the normalized vault
+# ("float32", "float16", "bfloat16"). Half precision halves the bytes read per query.
+DEFAULT_RAG_DEVICE = os.getenv("RAG_DEVICE", "cpu").strip() or "cpu"
+DEFAULT_VAULT_DTYPE = os.getenv("RAG_VAULT_DTYPE", "float32").strip().lower()
+DEFAULT_THREAD_CACHE_SIZE = int(os.getenv("WHATSAPP_THREAD_CACHE_SIZE", "1024"))
+DEFAULT_THREAD_WRITE_BATCH = int("64")
+# Threads used to embed the query while the classifier call is still in flight.
+DEFAULT_PREFETCH_WORKERS = int(os.getenv("RAG_PREFETCH_WORKERS", "4"))
+DEFAULT_CLASSIFIER_CACHE_SIZE = int(os.getenv("RAG_CLASSIFIER_CACHE_SIZE", "4096"))
+# Seconds a cached classifier verdict stays valid (0 keeps entries until evicted).
+DEFAULT_CLASSIFIER_CACHE_TTL = float(os.getenv("RAG_CLASSIFIER_CACHE_TTL", "3600"))
+# Query embeddings requested by different conversations within this window (milliseconds)
+# share one /api/embed call of at most DEFAULT_QUERY_EMBED_MAX_BATCH texts; 0 disables it.
+DEFAULT_QUERY_EMBED_WINDOW_MS = float(os.getenv("RAG_QUERY_EMBED_WINDOW_MS", "10"))
+DEFAULT_QUERY_EMBED_MAX_BATCH = max(1, int(os.getenv("RAG_QUERY_EMBED_MAX_BATCH", "16")))
+DEFAULT_QUERY_EMBED_CACHE_SIZE = int(os.getenv("RAG_QUERY_EMBED_CACHE_SIZE", "4096"))
+# Retrieval results remembered per conversation, so repeated questions skip embedding.
+DEFAULT_RECENT_QUERY_CACHE_SIZE = int(os.getenv("RAG_RECENT_QUERY_CACHE_SIZE", "4"))
 ALLOWED_TOPIC_PATTERNS = [
     re.compile(r"\boptimaxx\b", re.IGNORECASE),
     re.compile(r"\bansys\b", re.IGNORECASE),
@@ -70,9 +127,42 @@ ALLOWED_TOPIC_PATTERNS = [
     re.compile(r"\binternet[\s-]+of[\s-]+things\b", re.IGNORECASE),
     re.compile(r"\bcae\b", re.IGNORECASE),
 ]
+_matches_allowed_topic = compile_any_matcher(ALLOWED_TOPIC_PATTERNS)
+# Any hit here (handoff, account/payment trouble, academic or training requests) means the
+# LLM classifier must decide, even when the message names an allowed topic.
+FAST_CLASSIFY_BLOCKING_PATTERNS = [
+    re.compile(
+        r"\b(admin|agen|agent|operator|manusia|human|orang|cs|customer\s+service|staf|staff|sales|live)\b",
+        re.IGNORECASE,
+    ),
+    re.compile(
+        r"\b(hubungkan|sambungkan|telepon|telpon|call|komplain|keluhan|complain)\b",
+        re.IGNORECASE,
+    ),
+    re.compile(
+        r"\b(bayar|pembayaran|transaksi|refund|tagihan|invoice|akun|password|login)\b",
+        re.IGNORECASE,
+    ),
+    re.compile(
+        r"\b(skripsi|tesis|thesis|disertasi|tugas|kuliah|dosen|kampus|mahasiswa|uts|uas|makalah|joki)\b",
+        re.IGNORECASE,
+    ),
+    re.compile(
+        r"\b(belajar|pelajaran|training|pelatihan|kelas|kursus|les|mentoring|student)\b",
+        re.IGNORECASE,
+    ),
+]
+_matches_fast_classify_blocker = compile_any_matcher(FAST_CLASSIFY_BLOCKING_PATTERNS)
+# Skip the LLM classifier for messages that clearly name an allowed topic.
+DEFAULT_FAST_CLASSIFY = os.getenv("RAG_FAST_CLASSIFY", "1").strip().lower() in {
+    "1",
+    "true",
+    "yes",
+}
 HELP_INTENT_ACADEMIC = "ACADEMIC"
 HELP_INTENT_BUSINESS = "BUSINESS"
 HELP_INTENT_OTHER = "OTHER"
+_HELP_INTENTS = frozenset({HELP_INTENT_ACADEMIC, HELP_INTENT_BUSINESS, HELP_INTENT_OTHER})
 
 OPTIMAXX_SYSTEM_PROMPT = dedent(
     """
@@ -176,6 +266,85 @@ ACADEMIC_REFUSAL_MESSAGE = dedent(
     """
 ).strip()
 
+COMBINED_CLASSIFIER_INSTRUCTION = dedent(
+    """
+    Kamu adalah pengklasifikasi cepat untuk pesan WhatsApp Optimaxx.
+    Balas HANYA dengan satu JSON sesuai skema:
+    {
+      "needs_human": true|false,
+      "handoff_reason": "alasan singkat dalam bahasa Indonesia",
+      "help_intent": "ACADEMIC"|"BUSINESS"|"OTHER",
+      "is_domain_question": true|false,
+      "can_answer_without_context": true|false
+    }
+
+    Aturan:
+    - needs_human panduan:
+        - Jawab true HANYA jika:
+        1) Pengirim JELAS dan EKPLISIT meminta untuk berbicara dengan manusia, agen, admin, atau dukungan manual
+            (misalnya: "mau bicara dengan admin", "tolong hubungkan ke orang", "saya mau live agent"),
+            
+        DAN
+
+        2) Isi pesan menunjukkan bahwa kasusnya PENTING atau TIDAK COCOK ditangani otomatis,
+            misalnya: masalah pembayaran/transaksi, akses akun/keamanan, kendala teknis berulang
+            setelah beberapa kali coba, atau eskalasi komplain serius.
+
+        - Jika pesan hanya berisi pertanyaan umum, salam, komplain ringan, atau permintaan bantuan yang masih bisa dijawab oleh bot (misalnya FAQ, penjelasan produk, cara pakai software), jawablah false, bahkan jika pengguna menyebut kata "bantu".
+        - Jika pengguna meminta manusia/admin secara umum tetapi konteksnya tampak sederhana atau tidak jelas penting/krisis, utamakan menjawab false.
+        - Jawab false untuk semua maksud lain (pertanyaan umum, permintaan info, keluhan tanpa permintaan manusia yang jelas dan penting, dsb.).
+        - Jika kamu RAGU apakah benar-benar perlu intervensi manusia, SELALU pilih false.
+        
+    - handoff_reason: Jelaskan secara singkat dalam bahasa Indonesia mengapa perlu intervensi manusia, atau kosongkan jika needs_human = false.
+    - help_intent: ACADEMIC jika terkait skripsi / tugas kuliah / dosen / pelajaran / training akademik / joki; BUSINESS jika soal layanan Optimaxx / ANSYS / IoT / CAE / kerja sama; lainnya = OTHER.
+    - is_domain_question = true jika topik dalam lingkup Optimaxx / ANSYS / IoT / CAE, selain itu false.
+    - can_answer_without_context = true hanya jika pertanyaan bisa dijawab umum tanpa dokumen tambahan; kalau ragu pilih false.
+    - Jangan sertakan backtick, teks tambahan, atau penjelasan di luar objek JSON tersebut.
+    """
+).strip()
+
+OUT_OF_SCOPE_RESPONSE = dedent(
+    """
+    Maaf, saya hanya dapat membantu pertanyaan yang berkaitan dengan layanan Optimaxx, ANSYS, IoT, atau CAE. 
+    Silakan ajukan pertanyaan dalam ruang lingkup tersebut agar saya bisa membantu dengan tepat. 🙂
+
+    📧 Email: info@optimaxx.id
+    🌐 Website: https://optimaxx.id
+    """
+).strip()
+
+NO_CONTEXT_FALLBACK_RESPONSE = dedent(
+    """
+    Mohon maaf, saya belum memiliki informasi mengenai hal tersebut saat ini. 
+    Untuk bantuan lebih lanjut, silakan menghubungi tim Optimaxx ya. 😊
+
+    📧 Email: info@optimaxx.id
+    🌐 Website: https://optimaxx.id
+    """
+).strip()
+
+GENERAL_ANSWER_INSTRUCTIONS = dedent(
+    """
+    Instruksi tambahan:
+    - Jawab hanya jika pertanyaan dapat dijelaskan secara umum atau berdasarkan riwayat yang diberikan.
+    - Jika saat menjawab Anda menyadari bahwa informasi spesifik masih hilang, katakan dengan sopan bahwa data tersebut belum tersedia dan sarankan pengguna menghubungi tim Optimaxx.
+    """
+).strip()
+
+MESSAGE_TOO_SHORT_RESPONSE = dedent(
+    """
+    Mohon maaf, pesan Anda perlu lebih dari 20 karakter ya. 
+    Silakan tambahkan sedikit penjelasan atau kata kunci agar saya bisa membantu dengan lebih tepat. 🙂
+    """
+).strip()
+
+MESSAGE_TOO_LONG_RESPONSE = dedent(
+    """
+    Mohon maaf, pesan Anda terlalu panjang. 
+    Silakan kirim pesan yang lebih singkat agar saya dapat memprosesnya dengan baik. 🙂
+    """
+).strip()
+
 # =========================
 # Utils
 # =========================
@@ -194,15 +363,18 @@ def _extract_json_object(raw: str) -> Dict[str, Any] | None:
         return None
     raw = raw.strip()
     try:
-        return json.loads(raw)
-    except json.JSONDecodeError:
-        match = re.search(r"\{.*\}", raw, flags=re.DOTALL)
-        if match:
-            try:
-                return json.loads(match.group(0))
-            except json.JSONDecodeError:
-                return None
-    return None
+        return fast_json.loads(raw)
+    except fast_json.JSONDecodeError:
+        pass
+    # Fall back to the outermost {...} span, e.g. when the model wraps the JSON in prose.
+    start = raw.find("{")
+    end = raw.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        return fast_json.loads(raw[start : end + 1])
+    except fast_json.JSONDecodeError:
+        return None
 
 
 def safe_print_info(msg: str) -> None:
@@ -217,50 +389,298 @@ def safe_print_section(title: str) -> None:
     print(PINK + title + RESET_COLOR)
 
 
+@lru_cache(maxsize=None)
+def _get_device() -> "torch.device":
+    import torch
+
+    try:
+        device = torch.device(DEFAULT_RAG_DEVICE)
+    except (RuntimeError, ValueError):
+        safe_print_warn(f"[warn] RAG_DEVICE={DEFAULT_RAG_DEVICE!r} tidak valid; memakai CPU.")
+        return torch.device("cpu")
+    if device.type == "cuda" and not torch.cuda.is_available():
+        safe_print_warn("[warn] CUDA tidak tersedia; retrieval memakai CPU.")
+        return torch.device("cpu")
+    return device
+
+
+def _vault_dtype() -> "torch.dtype":
+    import torch
+
+    dtypes = {
+        "float32": torch.float32,
+        "float16": torch.float16,
+        "bfloat16": torch.bfloat16,
+    }
+    if DEFAULT_VAULT_DTYPE not in dtypes:
+        safe_print_warn(
+            f"[warn] RAG_VAULT_DTYPE={DEFAULT_VAULT_DTYPE!r} tidak dikenal; memakai float32."
+        )
+        return torch.float32
+    return dtypes[DEFAULT_VAULT_DTYPE]
+
+
+# =========================
+# Ollama client
+# =========================
+_OLLAMA_CLIENT: Any = None
+_OLLAMA_CLIENT_LOCK = Lock()
+
+
+def get_ollama_client() -> Any:
+    """
+    Return the process-wide Ollama client so every call reuses one pooled HTTP connection.
+    Falls back to the module-level ollama API if a client cannot be created.
+    """
+    global _OLLAMA_CLIENT
+    if _OLLAMA_CLIENT is not None:
+        return _OLLAMA_CLIENT
+    import ollama
+
+    with _OLLAMA_CLIENT_LOCK:
+        if _OLLAMA_CLIENT is None:
+            try:
+                _OLLAMA_CLIENT = ollama.Client()
+            except Exception as err:
+                safe_print_warn(f"[warn] gagal membuat Ollama client: {err}")
+                return ollama
+    return _OLLAMA_CLIENT
+
+
 # =========================
 # Embeddings + Retrieval
 # =========================
+def _embedding_cache_path(text: str, model: str) -> Path:
+    key = hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+    return EMBED_VECTOR_CACHE_DIR / f"{key}.npy"
+
+
+def _load_cached_embedding(text: str, model: str) -> List[float] | None:
+    import numpy as np
+
+    path = _embedding_cache_path(text, model)
+    if not path.exists():
+        return None
+    try:
+        return np.load(path).tolist()
+    except Exception as exc:
+        safe_print_warn(f"[warn] gagal membaca cache embedding {path.name}: {exc}")
+        return None
+
+
+def _store_cached_embedding(text: str, model: str, vector: List[float]) -> None:
+    import numpy as np
+
+    path = _embedding_cache_path(text, model)
+    try:
+        np.save(path, np.asarray(vector, dtype=np.float32))
+    except Exception as exc:
+        safe_print_warn(f"[warn] gagal menyimpan cache embedding {path.name}: {exc}")
+
+
+_EMBED_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, ...]]" = OrderedDict()
+_EMBED_CACHE_LOCK = Lock()
+
+
+def _get_cached_embedding(model: str, text: str) -> Tuple[float, ...] | None:
+    with _EMBED_CACHE_LOCK:
+        cached = _EMBED_CACHE.get((model, text))
+        if cached is not None:
+            _EMBED_CACHE.move_to_end((model, text))
+        return cached
+
+
+def _store_embedding(model: str, text: str, vector: Tuple[float, ...]) -> None:
+    if DEFAULT_QUERY_EMBED_CACHE_SIZE <= 0:
+        return
+    with _EMBED_CACHE_LOCK:
+        _EMBED_CACHE[(model, text)] = vector
+        _EMBED_CACHE.move_to_end((model, text))
+        while len(_EMBED_CACHE) > DEFAULT_QUERY_EMBED_CACHE_SIZE:
+            _EMBED_CACHE.popitem(last=False)
+
+
+def _embed_one(model: str, text: str) -> Tuple[float, ...]:
+    """
+    Embed a single text with Ollama, memoized per (model, text) across calls.
+    Raises on failure so errors are never cached.
+    """
+    cached = _get_cached_embedding(model, text)
+    if cached is not None:
+        return cached
+    response = get_ollama_client().embeddings(model=model, prompt=text)
+    vector = tuple(response["embedding"])
+    _store_embedding(model, text, vector)
+    return vector
+
+
+_PREFETCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, DEFAULT_PREFETCH_WORKERS), thread_name_prefix="rag-prefetch"
+)
+_QUERY_EMBED_QUEUE: "Queue[Tuple[str, str, Future]]" = Queue()
+_QUERY_EMBED_BATCHER: Thread | None = None
+_QUERY_EMBED_BATCHER_LOCK = Lock()
+
+
+def _resolve_query_embeddings(model: str, waiting: Dict[str, List[Future]]) -> None:
+    """Embed the distinct texts in waiting with one /api/embed call and settle their futures."""
+    texts = list(waiting)
+    vectors: List[Tuple[float, ...]] | None = None
+    if len(texts) > 1:
+        try:
+            response = get_ollama_client().embed(model=model, input=texts)
+            vectors = [tuple(vec) for vec in response["embeddings"]]
+        except Exception as exc:
+            safe_print_warn(f"[warn] batch query embedding failed; retrying per query: {exc}")
+        if vectors is not None and len(vectors) != len(texts):
+            safe_print_warn("[warn] batch query embedding count mismatch; retrying per query.")
+            vectors = None
+    for index, text in enumerate(texts):
+        futures = waiting[text]
+        try:
+            if vectors is None:
+                vector = _embed_one(model, text)
+            else:
+                vector = vectors[index]
+                _store_embedding(model, text, vector)
+        except Exception as exc:
+            for future in futures:
+                future.set_exception(exc)
+            continue
+        for future in futures:
+            future.set_result(vector)
+
+
+def _query_embed_batcher_loop() -> None:
+    window = DEFAULT_QUERY_EMBED_WINDOW_MS / 1000.0
+    while True:
+        jobs = [_QUERY_EMBED_QUEUE.get()]
+        deadline = time.monotonic() + window
+        while len(jobs) < DEFAULT_QUERY_EMBED_MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(_QUERY_EMBED_QUEUE.get(timeout=remaining))
+            except Empty:
+                break
+        by_model: Dict[str, Dict[str, List[Future]]] = {}
+        for model, text, future in jobs:
+            by_model.setdefault(model, {}).setdefault(text, []).append(future)
+        for model, waiting in by_model.items():
+            # Resolve off this thread so the next window starts collecting right away.
+            _PREFETCH_EXECUTOR.submit(_resolve_query_embeddings, model, waiting)
+
+
+def _ensure_query_embed_batcher() -> None:
+    global _QUERY_EMBED_BATCHER
+    if _QUERY_EMBED_BATCHER is not None:
+        return
+    with _QUERY_EMBED_BATCHER_LOCK:
+        if _QUERY_EMBED_BATCHER is not None:
+            return
+        _QUERY_EMBED_BATCHER = Thread(
+            target=_query_embed_batcher_loop, daemon=True, name="rag-query-embed-batcher"
+        )
+        _QUERY_EMBED_BATCHER.start()
+
+
+def _prefetch_query_embedding(text: str, model: str) -> Future:
+    """
+    Start embedding text in the background so it overlaps with other Ollama calls.
+    Requests from concurrent conversations are micro-batched into one /api/embed call;
+    the short wait is hidden behind the classifier call that runs meanwhile.
+    """
+    cached = _get_cached_embedding(model, text)
+    if cached is not None:
+        future: Future = Future()
+        future.set_result(cached)
+        return future
+    if DEFAULT_QUERY_EMBED_WINDOW_MS <= 0 or DEFAULT_QUERY_EMBED_MAX_BATCH <= 1:
+        return _PREFETCH_EXECUTOR.submit(_embed_one, model, text)
+    future = Future()
+    _ensure_query_embed_batcher()
+    _QUERY_EMBED_QUEUE.put((model, text, future))
+    return future
+
+
 def embed_texts_ollama(texts: List[str], model: str) -> List[List[float]]:
     """
     Embed a list of texts with Ollama. Returns list of embedding vectors.
+    Vectors are cached on disk per (model, text); misses are sent in batches to /api/embed,
+    falling back to one request per text if the batch call fails.
     """
     if not texts:
         return []
 
-    client_factory = getattr(ollama, "Client", None)
-    client = None
-    if callable(client_factory):
-        try:
-            client = client_factory()
-        except Exception as err:
-            safe_print_warn(f"[warn] gagal membuat Ollama client: {err}")
-            client = None
+    client = get_ollama_client()
 
     def _embed_once(prompt: str) -> List[float] | None:
         try:
-            if client is not None:
-                response = client.embeddings(model=model, prompt=prompt)
-            else:
-                response = ollama.embeddings(model=model, prompt=prompt)
-            return list(response["embedding"])
+            return list(_embed_one(model, prompt))
         except Exception as exc:
             safe_print_warn(f"[warn] embedding failed for a line: {exc}")
             return None
 
-    cache: Dict[str, List[float]] = {}
-    vectors: List[List[float]] = []
+    def _embed_batch(prompts: List[str]) -> List[List[float]] | None:
+        try:
+            response = client.embed(model=model, input=prompts)
+            embeddings = [list(vec) for vec in response["embeddings"]]
+        except Exception as exc:
+            safe_print_warn(f"[warn] batch embedding failed; retrying per line: {exc}")
+            return None
+        if len(embeddings) != len(prompts):
+            safe_print_warn("[warn] batch embedding count mismatch; retrying per line.")
+            return None
+        return embeddings
+
+    resolved: Dict[str, List[float]] = {}
+    pending: Dict[str, None] = {}
     for text in texts:
         key = text.strip()
-        if key in cache:
-            vectors.append(list(cache[key]))
+        if key in resolved or key in pending:
             continue
-        vec = _embed_once(text)
-        if vec is None:
-            safe_print_warn("[warn] embedding skipped due to previous error.")
-            continue
-        cache[key] = vec
-        vectors.append(list(vec))
-
+        cached = _load_cached_embedding(key, model)
+        if cached is not None:
+            resolved[key] = cached
+        else:
+            pending[key] = None
+    misses = list(pending)
+
+    def _embed_batch_or_lines(batch: List[str]) -> List[List[float] | None]:
+        batch_vectors = _embed_batch(batch)
+        if batch_vectors is None:
+            batch_vectors = [_embed_once(prompt) for prompt in batch]
+        return batch_vectors
+
+    batches = [
+        misses[start : start + DEFAULT_EMBED_BATCH_SIZE]
+        for start in range(0, len(misses), DEFAULT_EMBED_BATCH_SIZE)
+    ]
+    executor = None
+    if len(batches) > 1 and DEFAULT_EMBED_CONCURRENCY > 1:
+        # Keep several batches in flight so network time overlaps server-side compute;
+        # results still arrive in order and are cached as each batch completes.
+        executor = ThreadPoolExecutor(
+            max_workers=min(DEFAULT_EMBED_CONCURRENCY, len(batches)),
+            thread_name_prefix="rag-embed",
+        )
+        batch_results = executor.map(_embed_batch_or_lines, batches)
+    else:
+        batch_results = map(_embed_batch_or_lines, batches)
+    try:
+        for batch, batch_vectors in zip(batches, batch_results):
+            for key, vec in zip(batch, batch_vectors):
+                if vec is None:
+                    safe_print_warn("[warn] embedding skipped due to previous error.")
+                    continue
+                resolved[key] = vec
+                _store_cached_embedding(key, model, vec)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    vectors = [list(resolved[key]) for key in (text.strip() for text in texts) if key in resolved]
     if len(vectors) != len(texts):
         safe_print_warn(
             "[warn] embedding count mismatch; skipping partial embeddings to avoid misalignment."
@@ -274,26 +694,53 @@ def cosine_topk(
     doc_matrix: torch.Tensor,
     k: int,
     *,
-    doc_matrix_normalized: bool = False,
-) -> List[Tuple[int, float]]:
+    min_similarity: float | None = None,
+    doc_scale: torch.Tensor | None = None,
+    ordered: bool = True,
+) -> List[int]:
     """
-    Cosine similarity between single query [D] and doc_matrix [N, D].
-    Returns list of (index, score) pairs sorted by similarity.
+    Cosine similarity between single query [D] and row-normalized doc_matrix [N, D].
+    doc_matrix may be float16/bfloat16, or int8 with per-row doc_scale [N]
+    (see _quantize_embedding_matrix), scored DEFAULT_INT8_SCORE_CHUNK_ROWS rows at a time;
+    scores are always compared in float32.
+    Returns indices of the top-k rows keeping only scores >= min_similarity,
+    sorted by similarity unless ordered=False.
     """
+    import torch
+    import torch.nn.functional as F
+
     if doc_matrix.numel() == 0:
         return []
     if doc_matrix.device != query_vec.device:
         doc_matrix = doc_matrix.to(query_vec.device)
-    q = F.normalize(query_vec.unsqueeze(0), dim=1)  # [1, D]
-    d = (
-        doc_matrix if doc_matrix_normalized else F.normalize(doc_matrix, dim=1)
-    )  # [N, D]
-    sims = torch.mm(q, d.transpose(0, 1)).squeeze(0)  # [N]
+    q = F.normalize(query_vec, dim=0)  # [D]
+    if doc_scale is not None:
+        sims = torch.empty(doc_matrix.shape[0], dtype=torch.float32, device=q.device)  # [N]
+        for start in range(0, doc_matrix.shape[0], DEFAULT_INT8_SCORE_CHUNK_ROWS):
+            end = start + DEFAULT_INT8_SCORE_CHUNK_ROWS
+            torch.mv(doc_matrix[start:end].to(torch.float32), q, out=sims[start:end])
+        sims.mul_(doc_scale.to(q.device))
+    else:
+        sims = torch.mv(doc_matrix, q.to(doc_matrix.dtype)).to(torch.float32)  # [N]
     k = min(k, sims.numel())
     if k == 0:
         return []
-    values, indices = torch.topk(sims, k=k)
-    return [(indices[i].item(), values[i].item()) for i in range(k)]
+    if min_similarity is not None:
+        # Threshold first: usually only a handful of rows survive, so topk/sort stay tiny.
+        candidates = torch.nonzero(sims >= min_similarity).squeeze(1)
+        if candidates.numel() == 0:
+            return []
+        sims = sims[candidates]
+        k = min(k, sims.numel())
+    else:
+        candidates = None
+    values, indices = torch.topk(sims, k=k, sorted=False)
+    if ordered:
+        values, order = torch.sort(values, descending=True)
+        indices = indices[order]
+    if candidates is not None:
+        indices = candidates[indices]
+    return indices.tolist()
 
 
 def get_relevant_context(
@@ -304,11 +751,14 @@ def get_relevant_context(
     embed_model: str,
     min_similarity: float,
     *,
-    vault_embeddings_norm: torch.Tensor | None = None,
+    vault_scale: torch.Tensor | None = None,
+    query_embedding: Future | None = None,
 ) -> List[str]:
     """
-    Embed the query, cosine-match against vault embeddings, return top chunks above threshold.
+    Embed the query, cosine-match against row-normalized vault embeddings, return top chunks above threshold.
+    query_embedding may carry an embedding already requested via _prefetch_query_embedding.
     """
+    import torch
 
     if rewritten_input.strip() == "":
         safe_print_warn(f"Input is empty; skipping retrieval.")
@@ -316,25 +766,50 @@ def get_relevant_context(
     if vault_embeddings.numel() == 0:
         return []
     try:
-        q_emb = ollama.embeddings(model=embed_model, prompt=rewritten_input)[
-            "embedding"
-        ]
+        if query_embedding is not None:
+            q_emb = query_embedding.result()
+        else:
+            q_emb = _embed_one(embed_model, rewritten_input)
     except Exception as e:
         safe_print_warn(f"[warn] embeddings failed via Ollama: {e}")
         return []
-    q_vec = torch.tensor(q_emb, dtype=torch.float32, device=DEVICE)  # [D]
-    search_matrix = (
-        vault_embeddings_norm if vault_embeddings_norm is not None else vault_embeddings
-    )
-    top_hits = cosine_topk(
+    q_vec = torch.tensor(q_emb, dtype=torch.float32, device=_get_device())  # [D]
+    top_idxs = cosine_topk(
         q_vec,
-        search_matrix,
+        vault_embeddings,
         top_k,
-        doc_matrix_normalized=vault_embeddings_norm is not None,
+        min_similarity=min_similarity,
+        doc_scale=vault_scale,
     )
-    return [
-        vault_content[idx].strip() for idx, score in top_hits if score >= min_similarity
-    ]
+    return [vault_content[idx].strip() for idx in top_idxs]
+
+
+def _recent_query_key(query: str, embed_model: str, top_k: int, min_similarity: float) -> str:
+    """Cache key for a retrieval: vault digest, retrieval settings, and whitespace/case-folded query."""
+    normalized = " ".join(query.casefold().split())
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(
+        f"{_VAULT_DIGEST}\n{embed_model}\n{top_k}\n{min_similarity}\n{normalized}".encode(
+            "utf-8", "surrogatepass"
+        )
+    )
+    return digest.hexdigest()
+
+
+def _lookup_recent_context(recent_queries: List[List[Any]], key: str) -> List[str] | None:
+    for entry_key, chunks in recent_queries:
+        if entry_key == key:
+            return list(chunks)
+    return None
+
+
+def _remember_recent_context(
+    recent_queries: List[List[Any]], key: str, chunks: List[str]
+) -> None:
+    """Put key first (most recent) and keep at most DEFAULT_RECENT_QUERY_CACHE_SIZE entries."""
+    recent_queries[:] = [entry for entry in recent_queries if entry[0] != key]
+    recent_queries.insert(0, [key, list(chunks)])
+    del recent_queries[DEFAULT_RECENT_QUERY_CACHE_SIZE:]
 
 
 # =========================
@@ -359,7 +834,12 @@ def ollama_chat_call(
         options["top_k"] = top_k
     if repeat_penalty is not None:
         options["repeat_penalty"] = repeat_penalty
-    resp = ollama.chat(model=model, messages=messages, options=options)
+    resp = get_ollama_client().chat(
+        model=model,
+        messages=messages,
+        options=options,
+        keep_alive=DEFAULT_OLLAMA_KEEP_ALIVE,
+    )
     return strip_think(resp["message"]["content"])
 
 
@@ -370,13 +850,14 @@ def build_guardrail_system_message(fallback: str | None) -> str:
     return fallback or OPTIMAXX_SYSTEM_PROMPT
 
 
+@lru_cache(maxsize=1024)
 def _contains_allowed_topic(text: str) -> bool:
     """
-    Check if text contains any allowed topic keywords.
+    Check if text contains any allowed topic keywords (cached; WhatsApp often re-delivers).
     """
     if not text:
         return False
-    return any(pattern.search(text) for pattern in ALLOWED_TOPIC_PATTERNS)
+    return _matches_allowed_topic(text)
 
 
 def _collect_user_history_text(
@@ -384,9 +865,12 @@ def _collect_user_history_text(
 ) -> str:
     """
     Join recent user-authored, AI-readable messages for classifier context.
+    Walks backwards and stops after limit lines, so the cost does not grow with the thread.
     """
     user_lines: List[str] = []
-    for msg in messages:
+    for msg in reversed(messages):
+        if 0 < limit <= len(user_lines):
+            break
         if not msg.get("ai_readable", True):
             continue
         if str(msg.get("role", "")).lower() != "user":
@@ -394,11 +878,97 @@ def _collect_user_history_text(
         content = str(msg.get("content") or "").strip()
         if content:
             user_lines.append(content)
-    if limit > 0:
-        user_lines = user_lines[-limit:]
+    user_lines.reverse()
     return "\n".join(user_lines).strip()
 
 
+def _fast_classify(question: str) -> Dict[str, Any] | None:
+    """
+    Deterministic stand-in for _run_combined_checks on clearly in-domain questions.
+    Returns None whenever the message is ambiguous and needs the LLM classifier.
+    """
+    if not DEFAULT_FAST_CLASSIFY or not question:
+        return None
+    if not _contains_allowed_topic(question) or _matches_fast_classify_blocker(question):
+        return None
+    checks = _default_checks()
+    checks["help_intent"] = HELP_INTENT_BUSINESS
+    return checks
+
+
+def _default_checks() -> Dict[str, Any]:
+    return {
+        "needs_human": False,
+        "handoff_reason": "",
+        "help_intent": HELP_INTENT_OTHER,
+        "is_domain_question": True,
+        "can_answer_without_context": False,
+    }
+
+
+# Classifier calls in flight, keyed by (model, question, history). Identical messages
+# arriving together (e.g. duplicate webhook deliveries) wait on the first call.
+_CLASSIFIER_INFLIGHT: Dict[Tuple[str, str, str], Future] = {}
+_CLASSIFIER_INFLIGHT_LOCK = Lock()
+_CLASSIFIER_INFLIGHT_WAIT_SECONDS = 30.0
+# The classifier runs at temperature 0, so its flags are cached per input digest
+# (LRU of (stored_at, checks), expiring after DEFAULT_CLASSIFIER_CACHE_TTL seconds).
+_CLASSIFIER_CACHE: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_CLASSIFIER_CACHE_LOCK = Lock()
+_CLASSIFIER_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+
+def _classifier_cache_key(model: str, question: str, user_history_text: str) -> bytes:
+    """Digest of the classifier inputs; case and whitespace in the question are folded."""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (model, " ".join(question.casefold().split()), user_history_text):
+        digest.update(part.encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.digest()
+
+
+def _get_cached_checks(key: bytes) -> Dict[str, Any] | None:
+    with _CLASSIFIER_CACHE_LOCK:
+        entry = _CLASSIFIER_CACHE.get(key)
+        if entry is None:
+            _CLASSIFIER_CACHE_STATS["misses"] += 1
+            return None
+        stored_at, cached = entry
+        if (
+            DEFAULT_CLASSIFIER_CACHE_TTL > 0
+            and time.monotonic() - stored_at > DEFAULT_CLASSIFIER_CACHE_TTL
+        ):
+            del _CLASSIFIER_CACHE[key]
+            _CLASSIFIER_CACHE_STATS["expirations"] += 1
+            _CLASSIFIER_CACHE_STATS["misses"] += 1
+            return None
+        _CLASSIFIER_CACHE.move_to_end(key)
+        _CLASSIFIER_CACHE_STATS["hits"] += 1
+        return dict(cached)
+
+
+def _store_cached_checks(key: bytes, checks: Dict[str, Any]) -> None:
+    # Handoff verdicts are never reused: each request for a human is classified afresh.
+    if DEFAULT_CLASSIFIER_CACHE_SIZE <= 0 or checks.get("needs_human"):
+        return
+    with _CLASSIFIER_CACHE_LOCK:
+        _CLASSIFIER_CACHE[key] = (time.monotonic(), dict(checks))
+        _CLASSIFIER_CACHE.move_to_end(key)
+        while len(_CLASSIFIER_CACHE) > DEFAULT_CLASSIFIER_CACHE_SIZE:
+            _CLASSIFIER_CACHE.popitem(last=False)
+            _CLASSIFIER_CACHE_STATS["evictions"] += 1
+
+
+def classifier_cache_stats() -> Dict[str, Any]:
+    """Counters and size of the classifier verdict cache in this process."""
+    with _CLASSIFIER_CACHE_LOCK:
+        stats: Dict[str, Any] = dict(_CLASSIFIER_CACHE_STATS)
+        stats["size"] = len(_CLASSIFIER_CACHE)
+    stats["max_size"] = DEFAULT_CLASSIFIER_CACHE_SIZE
+    stats["ttl_seconds"] = DEFAULT_CLASSIFIER_CACHE_TTL
+    return stats
+
+
 def _run_combined_checks(
     question: str,
     user_history_text: str,
@@ -415,60 +985,62 @@ def _run_combined_checks(
       "can_answer_without_context": bool
     }
     """
-    defaults = {
-        "needs_human": False,
-        "handoff_reason": "",
-        "help_intent": HELP_INTENT_OTHER,
-        "is_domain_question": True,
-        "can_answer_without_context": False,
-    }
-
     if not question:
-        return defaults
-
-    instruction = dedent(
-        """
-        Kamu adalah pengklasifikasi cepat untuk pesan WhatsApp Optimaxx.
-        Balas HANYA dengan satu JSON sesuai skema:
-        {
-          "needs_human": true|false,
-          "handoff_reason": "alasan singkat dalam bahasa Indonesia",
-          "help_intent": "ACADEMIC"|"BUSINESS"|"OTHER",
-          "is_domain_question": true|false,
-          "can_answer_without_context": true|false
-        }
-
-        Aturan:
-        - needs_human panduan:
-            - Jawab true HANYA jika:
-            1) Pengirim JELAS dan EKPLISIT meminta untuk berbicara dengan manusia, agen, admin, atau dukungan manual
-                (misalnya: "mau bicara dengan admin", "tolong hubungkan ke orang", "saya mau live agent"),
-                
-            DAN
-
-            2) Isi pesan menunjukkan bahwa kasusnya PENTING atau TIDAK COCOK ditangani otomatis,
-                misalnya: masalah pembayaran/transaksi, akses akun/keamanan, kendala teknis berulang
-                setelah beberapa kali coba, atau eskalasi komplain serius.
-
-            - Jika pesan hanya berisi pertanyaan umum, salam, komplain ringan, atau permintaan bantuan yang masih bisa dijawab oleh bot (misalnya FAQ, penjelasan produk, cara pakai software), jawablah false, bahkan jika pengguna menyebut kata "bantu".
-            - Jika pengguna meminta manusia/admin secara umum tetapi konteksnya tampak sederhana atau tidak jelas penting/krisis, utamakan menjawab false.
-            - Jawab false untuk semua maksud lain (pertanyaan umum, permintaan info, keluhan tanpa permintaan manusia yang jelas dan penting, dsb.).
-            - Jika kamu RAGU apakah benar-benar perlu intervensi manusia, SELALU pilih false.
-            
-        - handoff_reason: Jelaskan secara singkat dalam bahasa Indonesia mengapa perlu intervensi manusia, atau kosongkan jika needs_human = false.
-        - help_intent: ACADEMIC jika terkait skripsi / tugas kuliah / dosen / pelajaran / training akademik / joki; BUSINESS jika soal layanan Optimaxx / ANSYS / IoT / CAE / kerja sama; lainnya = OTHER.
-        - is_domain_question = true jika topik dalam lingkup Optimaxx / ANSYS / IoT / CAE, selain itu false.
-        - can_answer_without_context = true hanya jika pertanyaan bisa dijawab umum tanpa dokumen tambahan; kalau ragu pilih false.
-        - Jangan sertakan backtick, teks tambahan, atau penjelasan di luar objek JSON tersebut.
-        """
-    ).strip()
-
-    user_payload = dedent(
-        f"""
-        Pesan terbaru: {question}
-        Riwayat pengguna terkait: {user_history_text or "(tidak ada)"}
-        """
-    ).strip()
+        return _default_checks()
+
+    cache_key = _classifier_cache_key(model, question, user_history_text)
+    cached = _get_cached_checks(cache_key)
+    if cached is not None:
+        return cached
+
+    key = (model, question, user_history_text)
+    with _CLASSIFIER_INFLIGHT_LOCK:
+        pending = _CLASSIFIER_INFLIGHT.get(key)
+        owner = pending is None
+        if owner:
+            pending = _CLASSIFIER_INFLIGHT[key] = Future()
+    if not owner:
+        try:
+            return dict(pending.result(timeout=_CLASSIFIER_INFLIGHT_WAIT_SECONDS))
+        except FutureTimeoutError:
+            logging.warning(
+                "Classifier call for an identical message is still running after %ss; "
+                "using default checks.",
+                _CLASSIFIER_INFLIGHT_WAIT_SECONDS,
+            )
+            return _default_checks()
+
+    try:
+        result = _classify_message(question, user_history_text, model)
+        if result is None:
+            result = _default_checks()
+        else:
+            _store_cached_checks(cache_key, result)
+    except BaseException as exc:
+        pending.set_exception(exc)
+        raise
+    else:
+        pending.set_result(result)
+    finally:
+        with _CLASSIFIER_INFLIGHT_LOCK:
+            _CLASSIFIER_INFLIGHT.pop(key, None)
+    return dict(result)
+
+
+def _classify_message(
+    question: str, user_history_text: str, model: str
+) -> Dict[str, Any] | None:
+    """
+    Issue the classifier request for _run_combined_checks and parse its flags.
+    Returns None when the call or parsing fails so the failure is not cached.
+    """
+    defaults = _default_checks()
+    instruction = COMBINED_CLASSIFIER_INSTRUCTION
+
+    user_payload = (
+        f"Pesan terbaru: {question}\n"
+        f"Riwayat pengguna terkait: {user_history_text or '(tidak ada)'}"
+    )
 
     try:
         raw = ollama_chat_call(
@@ -478,32 +1050,33 @@ def _run_combined_checks(
                 {"role": "user", "content": user_payload},
             ],
             temperature=0.0,
-            num_ctx=1536,
+            num_ctx=DEFAULT_CLASSIFIER_NUM_CTX,
             top_p=0.05,
             repeat_penalty=1.01,
         )
     except Exception as exc:
         logging.warning("Combined classifier failed: %s", exc)
-        return defaults
+        return None
 
     parsed = _extract_json_object(raw)
     if not isinstance(parsed, dict):
         logging.warning("Combined classifier returned non-dict: %s", raw)
-        return defaults
+        return None
 
-    out = dict(defaults)
-    out["needs_human"] = bool(parsed.get("needs_human", defaults["needs_human"]))
-    out["handoff_reason"] = str(parsed.get("handoff_reason") or "").strip()
     help_intent = str(parsed.get("help_intent") or "").strip().upper()
-    if help_intent in {HELP_INTENT_ACADEMIC, HELP_INTENT_BUSINESS, HELP_INTENT_OTHER}:
-        out["help_intent"] = help_intent
-    out["is_domain_question"] = bool(
-        parsed.get("is_domain_question", defaults["is_domain_question"])
-    )
-    out["can_answer_without_context"] = bool(
-        parsed.get("can_answer_without_context", defaults["can_answer_without_context"])
-    )
-    return out
+    if help_intent not in _HELP_INTENTS:
+        help_intent = defaults["help_intent"]
+    return {
+        "needs_human": bool(parsed.get("needs_human", defaults["needs_human"])),
+        "handoff_reason": str(parsed.get("handoff_reason") or "").strip(),
+        "help_intent": help_intent,
+        "is_domain_question": bool(
+            parsed.get("is_domain_question", defaults["is_domain_question"])
+        ),
+        "can_answer_without_context": bool(
+            parsed.get("can_answer_without_context", defaults["can_answer_without_context"])
+        ),
+    }
 
 
 def chat_with_rag(
@@ -516,7 +1089,7 @@ def chat_with_rag(
     conversation_history: List[Dict[str, Any]],
     user_entry: Dict[str, Any],
     *,
-    vault_embeddings_norm: torch.Tensor | None = None,
+    vault_scale: torch.Tensor | None = None,
     top_k: int = DEFAULT_TOP_K,
     min_similarity: float = DEFAULT_MIN_SIMILARITY,
     num_ctx: int = DEFAULT_NUM_CTX,
@@ -524,33 +1097,41 @@ def chat_with_rag(
     top_p: float = DEFAULT_GEN_TOP_P,
     repeat_penalty: float = DEFAULT_GEN_REPEAT_PENALTY,
     precomputed_checks: Dict[str, Any] | None = None,
+    query_embedding: Future | None = None,
+    recent_queries: List[List[Any]] | None = None,
 ) -> str:
     """
     Main single-turn RAG call: rewrite -> retrieve -> respond with context, history, or fallback.
+    vault_embeddings must be row-normalized (see _normalize_embedding_matrix), or int8
+    with vault_scale when quantized (see _quantize_embedding_matrix).
+    query_embedding is an optional prefetched embedding of user_input.
+    recent_queries is the thread's retrieval cache; it is read and updated in place.
     """
     conversation_history.append(user_entry)
     rewritten = user_input
     logging.debug("Incoming question: %s", user_input)
 
-    embeddings_norm = vault_embeddings_norm
-    if embeddings_norm is None:
-        embeddings_norm = _VAULT_EMB_NORM
-    if embeddings_norm is None and vault_embeddings.numel() > 0:
-        embeddings_norm = _normalize_embedding_matrix(vault_embeddings)
-
-    filtered_history = [
-        msg for msg in conversation_history if msg.get("ai_readable", True)
-    ]
-    previous_messages = filtered_history[:-1]
     if DEFAULT_MAX_HISTORY_TURNS <= 1 or DEFAULT_MODEL_HISTORY_WINDOW <= 0:
-        previous_messages = []
+        history_window = 0
     else:
         history_window = min(
             DEFAULT_MODEL_HISTORY_WINDOW, DEFAULT_MAX_HISTORY_TURNS - 1
         )
-        previous_messages = (
-            previous_messages[-history_window:] if history_window else []
-        )
+
+    # Walk back from the newest message and stop once the window is full, skipping
+    # the latest AI-readable entry (normally the user_entry appended above).
+    previous_messages: List[Dict[str, Any]] = []
+    skip_latest = True
+    for msg in reversed(conversation_history):
+        if len(previous_messages) >= history_window:
+            break
+        if not msg.get("ai_readable", True):
+            continue
+        if skip_latest:
+            skip_latest = False
+            continue
+        previous_messages.append(msg)
+    previous_messages.reverse()
 
     history_lines: List[str] = []
     user_history_lines: List[str] = []
@@ -563,7 +1144,7 @@ def chat_with_rag(
             history_lines.append(f"{role}:")
         elif content:
             history_lines.append(content)
-        if role.lower() == "user" and content:
+        if content and role.lower() == "user":
             user_history_lines.append(content)
     history_text = "\n".join(history_lines).strip()
     history_available = bool(history_text)
@@ -599,15 +1180,7 @@ def chat_with_rag(
         safe_print_warn(
             "Pertanyaan berada di luar cakupan Optimaxx/ANSYS/IoT/CAE. Mengirim penolakan."
         )
-        out_of_scope_message = dedent(
-            """
-            Maaf, saya hanya dapat membantu pertanyaan yang berkaitan dengan layanan Optimaxx, ANSYS, IoT, atau CAE. 
-            Silakan ajukan pertanyaan dalam ruang lingkup tersebut agar saya bisa membantu dengan tepat. 🙂
-
-            📧 Email: info@optimaxx.id
-            🌐 Website: https://optimaxx.id
-            """
-        ).strip()
+        out_of_scope_message = OUT_OF_SCOPE_RESPONSE
         if conversation_history and conversation_history[-1].get("role") == "user":
             conversation_history[-1]["ai_readable"] = False
         conversation_history.append(
@@ -615,15 +1188,24 @@ def chat_with_rag(
         )
         return out_of_scope_message
 
-    context_chunks = get_relevant_context(
-        rewritten_input=rewritten,
-        vault_embeddings=vault_embeddings,
-        vault_content=vault_content,
-        top_k=top_k,
-        embed_model=embed_model,
-        min_similarity=min_similarity,
-        vault_embeddings_norm=embeddings_norm,
-    )
+    context_chunks = None
+    if recent_queries is not None:
+        recent_key = _recent_query_key(rewritten, embed_model, top_k, min_similarity)
+        context_chunks = _lookup_recent_context(recent_queries, recent_key)
+    if context_chunks is None:
+        context_chunks = get_relevant_context(
+            rewritten_input=rewritten,
+            vault_embeddings=vault_embeddings,
+            vault_content=vault_content,
+            top_k=top_k,
+            embed_model=embed_model,
+            min_similarity=min_similarity,
+            vault_scale=vault_scale,
+            query_embedding=query_embedding,
+        )
+        # Empty results are not remembered: they may come from a failed embedding call.
+        if recent_queries is not None and context_chunks:
+            _remember_recent_context(recent_queries, recent_key, context_chunks)
 
     base_system = build_guardrail_system_message(system_message)
 
@@ -642,15 +1224,7 @@ def chat_with_rag(
         logging.debug("Can answer without context: %s", can_answer_without_context)
         if not can_answer_without_context:
             safe_print_warn("Melewati balasan karena tidak ada konteks relevan.")
-            fallback_message = dedent(
-                """
-                Mohon maaf, saya belum memiliki informasi mengenai hal tersebut saat ini. 
-                Untuk bantuan lebih lanjut, silakan menghubungi tim Optimaxx ya. 😊
-
-                📧 Email: info@optimaxx.id
-                🌐 Website: https://optimaxx.id
-                """
-            ).strip()
+            fallback_message = NO_CONTEXT_FALLBACK_RESPONSE
             if conversation_history and conversation_history[-1].get("role") == "user":
                 conversation_history[-1]["ai_readable"] = False
             conversation_history.append(
@@ -670,13 +1244,7 @@ def chat_with_rag(
         else:
             general_prompt_parts.append("Riwayat percakapan sebelumnya tidak tersedia.")
         general_prompt_parts.append(
-            dedent(
-                """
-                Instruksi tambahan:
-                - Jawab hanya jika pertanyaan dapat dijelaskan secara umum atau berdasarkan riwayat yang diberikan.
-                - Jika saat menjawab Anda menyadari bahwa informasi spesifik masih hilang, katakan dengan sopan bahwa data tersebut belum tersedia dan sarankan pengguna menghubungi tim Optimaxx.
-                """
-            ).strip()
+            GENERAL_ANSWER_INSTRUCTIONS
         )
         sys_content = "\n\n".join(general_prompt_parts)
 
@@ -716,8 +1284,9 @@ def load_vault(path: str | Path) -> List[str]:
         )
         return []
     try:
-        with vault_path.open("r", encoding="utf-8") as f:
-            chunks = [line.strip() for line in f if line.strip()]
+        # One read and one C-level split; read_text keeps universal-newline handling.
+        text = vault_path.read_text(encoding="utf-8")
+        chunks = [chunk for chunk in (line.strip() for line in text.split("\n")) if chunk]
     except OSError as exc:
         safe_print_warn(f"[warn] failed to read vault file {vault_path}: {exc}")
         return []
@@ -725,14 +1294,77 @@ def load_vault(path: str | Path) -> List[str]:
     return chunks
 
 
+def _hash_vault_content(blob: bytes) -> Tuple[str, str]:
+    """
+    Return (algorithm, hex digest) for the vault cache key. BLAKE3 hashes the blob
+    on several threads when installed; SHA-256 keeps caches written before it valid.
+    """
+    try:
+        import blake3
+    except ImportError:
+        return "sha256", hashlib.sha256(blob).hexdigest()
+    return "blake3", blake3.blake3(blob, max_threads=blake3.blake3.AUTO).hexdigest()
+
+
+def _load_vault_matrix_cache(
+    safetensors_path: Path, legacy_path: Path
+) -> torch.Tensor | None:
+    """
+    Load a cached vault matrix onto the retrieval device. safetensors files are
+    memory-mapped and copied once; the pickled .pt file is the legacy fallback.
+    """
+    import torch
+
+    if safetensors_path.exists():
+        try:
+            from safetensors import safe_open
+        except ImportError:
+            safe_open = None
+        if safe_open is not None:
+            with safe_open(
+                str(safetensors_path), framework="pt", device=str(_get_device())
+            ) as handle:
+                return handle.get_tensor("mat")
+    if not legacy_path.exists():
+        return None
+    load_kwargs: Dict[str, Any] = {"map_location": "cpu"}
+    try:
+        if "weights_only" in inspect.signature(torch.load).parameters:
+            load_kwargs["weights_only"] = True
+    except Exception:
+        pass
+    cached_tensor = torch.load(str(legacy_path), **load_kwargs)
+    if isinstance(cached_tensor, torch.Tensor):
+        return cached_tensor.to(_get_device())
+    return None
+
+
+def _save_vault_matrix_cache(
+    matrix: torch.Tensor, safetensors_path: Path, legacy_path: Path
+) -> None:
+    """Save as safetensors when available (else .pt) and drop the other format's stale file."""
+    import torch
+
+    try:
+        from safetensors.torch import save_file
+    except ImportError:
+        torch.save(matrix, str(legacy_path))
+        safetensors_path.unlink(missing_ok=True)
+        return
+    save_file({"mat": matrix.contiguous()}, str(safetensors_path))
+    legacy_path.unlink(missing_ok=True)
+
+
 def build_vault_embeddings(
     chunks: List[str], embed_model: str, vault_path: str | Path
 ) -> torch.Tensor:
     """
     Embed each chunk into a [N, D] tensor (or empty tensor if none), reusing cache when possible.
     """
+    import torch
+
     if not chunks:
-        return torch.empty((0,), dtype=torch.float32, device=DEVICE)
+        return torch.empty((0,), dtype=torch.float32, device=_get_device())
     vault_path = Path(vault_path)
     try:
         abs_vault_path = vault_path.resolve(strict=False)
@@ -741,32 +1373,24 @@ def build_vault_embeddings(
     sanitized_model = re.sub(r"[^a-zA-Z0-9_.-]", "_", embed_model)
     cache_prefix = f"{abs_vault_path.name}.{sanitized_model}"
     cache_tensor_path = EMBED_CACHE_DIR / f"{cache_prefix}.pt"
+    cache_st_path = EMBED_CACHE_DIR / f"{cache_prefix}.safetensors"
     cache_meta_path = EMBED_CACHE_DIR / f"{cache_prefix}.json"
-    hasher = hashlib.sha256()
-    hasher.update(str(embed_model).encode("utf-8"))
-    hasher.update(b"\n")
-    hasher.update(str(abs_vault_path).encode("utf-8"))
-    hasher.update(b"\n")
-    for chunk in chunks:
-        hasher.update(chunk.encode("utf-8"))
-        hasher.update(b"\n")
-    content_hash = hasher.hexdigest()
-
-    if cache_tensor_path.exists() and cache_meta_path.exists():
+    hash_algo, content_hash = _hash_vault_content(
+        "\n".join([str(embed_model), str(abs_vault_path), *chunks, ""]).encode("utf-8")
+    )
+
+    if cache_meta_path.exists():
         try:
             with cache_meta_path.open("r", encoding="utf-8") as meta_file:
                 metadata = json.load(meta_file)
-            if metadata.get("hash") == content_hash:
+            if (
+                metadata.get("hash") == content_hash
+                and metadata.get("hash_algo", "sha256") == hash_algo
+            ):
                 safe_print_info("Memuat embedding vault dari cache...")
-                load_kwargs: Dict[str, Any] = {"map_location": "cpu"}
-                try:
-                    if "weights_only" in inspect.signature(torch.load).parameters:
-                        load_kwargs["weights_only"] = True
-                except Exception:
-                    pass
-                cached_tensor = torch.load(str(cache_tensor_path), **load_kwargs)
-                if isinstance(cached_tensor, torch.Tensor):
-                    return cached_tensor.to(DEVICE)
+                cached_tensor = _load_vault_matrix_cache(cache_st_path, cache_tensor_path)
+                if cached_tensor is not None:
+                    return cached_tensor
         except Exception as e:
             safe_print_warn(f"[warn] gagal memuat cache embedding: {e}")
 
@@ -774,54 +1398,136 @@ def build_vault_embeddings(
     vectors = embed_texts_ollama(chunks, embed_model)
     if not vectors:
         safe_print_warn("[warn] tidak ada embedding yang valid; vault retrieval dinonaktifkan.")
-        return torch.empty((0,), dtype=torch.float32, device=DEVICE)
+        return torch.empty((0,), dtype=torch.float32, device=_get_device())
     try:
         mat_cpu = torch.tensor(vectors, dtype=torch.float32)  # [N, D]
     except Exception as e:
         safe_print_warn(f"[warn] failed to create embeddings tensor: {e}")
-        return torch.empty((0,), dtype=torch.float32, device=DEVICE)
+        return torch.empty((0,), dtype=torch.float32, device=_get_device())
     try:
-        torch.save(mat_cpu, str(cache_tensor_path))
+        _save_vault_matrix_cache(mat_cpu, cache_st_path, cache_tensor_path)
         with cache_meta_path.open("w", encoding="utf-8") as meta_file:
-            json.dump({"hash": content_hash, "shape": list(mat_cpu.shape)}, meta_file)
+            json.dump(
+                {
+                    "hash": content_hash,
+                    "hash_algo": hash_algo,
+                    "shape": list(mat_cpu.shape),
+                },
+                meta_file,
+            )
         safe_print_info("Embedding vault baru berhasil disimpan ke cache.")
     except Exception as e:
         safe_print_warn(f"[warn] gagal menyimpan cache embedding: {e}")
     safe_print_info(f"Bentuk embedding: {list(mat_cpu.shape)}")
-    return mat_cpu.to(DEVICE)
+    return mat_cpu.to(_get_device())
 
 
-def _normalize_embedding_matrix(matrix: torch.Tensor) -> torch.Tensor:
-    """Return a row-wise normalized copy to avoid repeated cosine normalization at query time."""
+def _normalize_embedding_matrix(
+    matrix: torch.Tensor, dtype: torch.dtype | None = None
+) -> torch.Tensor:
+    """
+    Return a row-wise normalized, contiguous copy so queries only normalize the query vector.
+    Normalization runs in float32; the result is stored as dtype (float32 by default).
+    """
+    import torch
+    import torch.nn.functional as F
+
     if not isinstance(matrix, torch.Tensor) or matrix.numel() == 0:
         return matrix
     try:
-        return F.normalize(matrix, dim=1)
+        normalized = F.normalize(matrix.to(torch.float32), dim=1)
+        return normalized.to(dtype or torch.float32).contiguous()
     except Exception as exc:
         safe_print_warn(f"[warn] gagal menormalisasi embedding vault: {exc}")
         return matrix
 
 
+def _quantize_embedding_matrix(matrix: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Quantize a row-normalized matrix to int8 rows plus a float32 per-row scale."""
+    import torch
+
+    scale = matrix.abs().amax(dim=1).clamp_min(1e-12) / 127.0  # [N]
+    quantized = (matrix / scale.unsqueeze(1)).round().clamp(-127, 127).to(torch.int8)
+    return quantized.contiguous(), scale.to(torch.float32)
+
+
 # =========================
 # Global init (lazy load vault/embeddings)
 # =========================
 _VAULT_CONTENT: List[str] | None = None
-_VAULT_EMB: torch.Tensor | None = None
+# Row-normalized vault embeddings; the raw matrix is not kept after load.
+# When DEFAULT_QUANTIZE_VAULT is set this holds int8 rows and _VAULT_EMB_SCALE their scales.
 _VAULT_EMB_NORM: torch.Tensor | None = None
+_VAULT_EMB_SCALE: torch.Tensor | None = None
+# Short digest of the vault text; part of the per-thread retrieval cache key.
+_VAULT_DIGEST = ""
+# Worker threads share one vault; the lock keeps them from building it concurrently.
+_VAULT_LOCK = Lock()
 
 
 def _ensure_vault_ready() -> None:
     """Load vault content/embeddings on first use to avoid heavy import-time side effects."""
-    global _VAULT_CONTENT, _VAULT_EMB, _VAULT_EMB_NORM
-    if _VAULT_CONTENT is not None and _VAULT_EMB is not None:
+    global _VAULT_CONTENT, _VAULT_EMB_NORM, _VAULT_EMB_SCALE, _VAULT_DIGEST
+    if _VAULT_CONTENT is not None and _VAULT_EMB_NORM is not None:
         return
-    safe_print_info("Loading vault content...")
-    _VAULT_CONTENT = load_vault(DEFAULT_VAULT)
-    _VAULT_EMB = build_vault_embeddings(_VAULT_CONTENT, DEFAULT_EMBED_MODEL, DEFAULT_VAULT)
-    _VAULT_EMB_NORM = _normalize_embedding_matrix(_VAULT_EMB)
+    with _VAULT_LOCK:
+        if _VAULT_CONTENT is not None and _VAULT_EMB_NORM is not None:
+            return
+        safe_print_info("Loading vault content...")
+        content = load_vault(DEFAULT_VAULT)
+        embeddings = _normalize_embedding_matrix(
+            build_vault_embeddings(content, DEFAULT_EMBED_MODEL, DEFAULT_VAULT),
+            dtype=None if DEFAULT_QUANTIZE_VAULT else _vault_dtype(),
+        )
+        scale = None
+        if DEFAULT_QUANTIZE_VAULT and embeddings.dim() == 2 and embeddings.numel() > 0:
+            embeddings, scale = _quantize_embedding_matrix(embeddings)
+        _VAULT_EMB_SCALE = scale
+        _VAULT_DIGEST = hashlib.blake2b(
+            "\n".join(content).encode("utf-8"), digest_size=8
+        ).hexdigest()
+        _VAULT_CONTENT = content
+        _VAULT_EMB_NORM = embeddings
+
+
+def preload_vault() -> None:
+    """Build the shared vault once up front (e.g. before worker threads start)."""
+    _ensure_vault_ready()
+
+
+def warm_system_prompt() -> None:
+    """
+    Load the generation model and evaluate OPTIMAXX_SYSTEM_PROMPT once, so Ollama's prompt
+    cache already holds that prefix (every chat_with_rag system message starts with it).
+    Uses the same num_ctx and keep_alive as real calls so the model is not reloaded.
+    """
+    try:
+        get_ollama_client().chat(
+            model=DEFAULT_GEN_MODEL,
+            messages=[
+                {"role": "system", "content": OPTIMAXX_SYSTEM_PROMPT},
+                {"role": "user", "content": "halo"},
+            ],
+            options={"num_ctx": DEFAULT_NUM_CTX, "num_predict": 1},
+            keep_alive=DEFAULT_OLLAMA_KEEP_ALIVE,
+        )
+    except Exception as exc:
+        safe_print_warn(f"[warn] gagal memanaskan system prompt: {exc}")
+
+
+# (epoch second, formatted) of the last call; timestamps have one-second resolution,
+# so calls within the same second reuse the string.
+_LAST_TIMESTAMP: Tuple[int, str] = (-1, "")
+
 
 def _timestamp() -> str:
-    return datetime.now(WIB).isoformat(timespec="seconds")
+    global _LAST_TIMESTAMP
+    second = int(time.time())
+    cached_second, formatted = _LAST_TIMESTAMP
+    if cached_second != second:
+        formatted = datetime.fromtimestamp(second, WIB).isoformat(timespec="seconds")
+        _LAST_TIMESTAMP = (second, formatted)
+    return formatted
 
 
 def _make_message(
@@ -859,10 +1565,25 @@ def _default_thread_state() -> Dict[str, Any]:
         "ai_paused": False,
         "handoff_reason": "",
         "handoff_ts": "",
-        "seen_message_ids": [],
+        # Ordered set (oldest first); stored as a plain list by _save_thread_state.
+        "seen_message_ids": OrderedDict(),
+        # [[query_key, context_chunks], ...], most recent first (see _remember_recent_context).
+        "recent_queries": [],
+        # Last message read from the store; _save_thread_state appends the ones after it.
+        "stored_tail": None,
+        # Handoff flags as read; _save_thread_state only writes them back once they change.
+        "stored_flags": (False, "", ""),
     }
 
 
+def _thread_flags(state: Dict[str, Any]) -> Tuple[bool, str, str]:
+    return (
+        bool(state.get("ai_paused")),
+        state.get("handoff_reason") or "",
+        state.get("handoff_ts") or "",
+    )
+
+
 def _normalize_thread_state(raw: Any) -> Dict[str, Any]:
     state = _default_thread_state()
     if isinstance(raw, dict):
@@ -871,6 +1592,14 @@ def _normalize_thread_state(raw: Any) -> Dict[str, Any]:
         state["handoff_ts"] = str(raw.get("handoff_ts") or "")
         messages = raw.get("messages", [])
         seen_ids = raw.get("seen_message_ids", [])
+        state["recent_queries"] = [
+            [entry[0], [str(chunk) for chunk in entry[1]]]
+            for entry in raw.get("recent_queries") or []
+            if isinstance(entry, (list, tuple))
+            and len(entry) == 2
+            and isinstance(entry[0], str)
+            and isinstance(entry[1], list)
+        ][:DEFAULT_RECENT_QUERY_CACHE_SIZE]
     elif isinstance(raw, list):
         messages = raw
         seen_ids = []
@@ -878,65 +1607,212 @@ def _normalize_thread_state(raw: Any) -> Dict[str, Any]:
         messages = []
         seen_ids = []
     state["messages"] = [_normalize_message(msg) for msg in messages]
-    state["seen_message_ids"] = [str(i) for i in seen_ids if i]
+    state["seen_message_ids"] = OrderedDict.fromkeys(str(i) for i in seen_ids if i)
+    state["stored_tail"] = state["messages"][-1] if state["messages"] else None
+    state["stored_flags"] = _thread_flags(state)
     return state
 
 
-# Per-thread lock to prevent concurrent writes to the shelve store for the same WA ID.
-_THREAD_LOCKS: Dict[str, Lock] = {}
-_THREAD_LOCKS_GUARD = Lock()
+# Per-thread lock to prevent concurrent writes to the thread store for the same WA ID.
+# Striped so memory stays constant: two numbers may share a stripe, which with 1024
+# stripes and a handful of workers only rarely serializes unrelated conversations.
+# whatsapp_queue already routes each chat to a single worker, so for queued jobs the
+# lock is uncontended; it still guards callers that run outside the queue.
+_THREAD_LOCK_STRIPES = 1024
+_THREAD_LOCKS = tuple(Lock() for _ in range(_THREAD_LOCK_STRIPES))
 
 
 def _get_thread_lock(wa_id: str) -> Lock:
     key = (wa_id or "").strip() or "__default__"
-    with _THREAD_LOCKS_GUARD:
-        lock = _THREAD_LOCKS.get(key)
-        if lock is None:
-            lock = Lock()
-            _THREAD_LOCKS[key] = lock
-    return lock
-
-
-def _ensure_thread_store_dir() -> None:
-    """Create threads_db_store directory if missing."""
-    try:
-        Path(THREADS_DB_PATH).parent.mkdir(parents=True, exist_ok=True)
-    except Exception:
-        logging.exception("Failed to create threads_db_store directory")
+    return _THREAD_LOCKS[hash(key) % _THREAD_LOCK_STRIPES]
 
 
 def _is_duplicate_message(message_id: str | None, state: Dict[str, Any]) -> bool:
     """Return True if we've already processed this message id for the thread."""
     if not message_id:
         return False
-    seen = state.get("seen_message_ids") or []
+    seen = state.get("seen_message_ids")
+    if not isinstance(seen, OrderedDict):
+        seen = OrderedDict.fromkeys(seen or ())
     if message_id in seen:
         return True
-    seen.append(message_id)
-    if len(seen) > DEFAULT_MAX_SEEN_IDS:
-        del seen[:-DEFAULT_MAX_SEEN_IDS]
+    seen[message_id] = None
+    while len(seen) > DEFAULT_MAX_SEEN_IDS:
+        seen.popitem(last=False)
     state["seen_message_ids"] = seen
     return False
 
 
+# =========================
+# Thread store (SQLite behind an in-memory LRU)
+# =========================
+# Reads are served from _THREADS_MEM; writes land in memory and _THREADS_PENDING
+# and are flushed to thread_store in batches by a single writer thread. Pending
+# writes are (new messages, payload fields) appended with thread_store.append_threads,
+# so rows written meanwhile by the dashboard are kept; handoff flags are only
+# included once the bot changes them.
+# _THREADS_MEM is dropped whenever the database files change behind our back
+# (e.g. dashboard edits); a thread with pending writes is then flushed before it
+# is re-read, so the bot sees the merged row. A change committed while our own
+# flush runs is only noticed with the next database change.
+_THREADS_MEM: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_THREADS_PENDING: Dict[str, Tuple[List[Dict[str, Any]], Dict[str, Any]]] = {}
+_THREADS_MEM_LOCK = Lock()
+_THREADS_DB_SIGNATURE: Tuple[int, ...] | None = None
+# Held across flushes so a read never sees the database between pop and write.
+_THREAD_DB_LOCK = Lock()
+_THREAD_WRITE_QUEUE: "Queue[str]" = Queue()
+_THREAD_WRITER: Thread | None = None
+_THREAD_WRITER_LOCK = Lock()
+
+
+def _remember_thread_payload(wa_id: str, payload: Dict[str, Any]) -> None:
+    """Insert payload into the LRU. Callers must hold _THREADS_MEM_LOCK."""
+    _THREADS_MEM[wa_id] = payload
+    _THREADS_MEM.move_to_end(wa_id)
+    while len(_THREADS_MEM) > DEFAULT_THREAD_CACHE_SIZE:
+        _THREADS_MEM.popitem(last=False)
+
+
+def _read_thread_payload(wa_id: str) -> Any:
+    global _THREADS_DB_SIGNATURE
+    signature = thread_store.store_signature()
+    with _THREADS_MEM_LOCK:
+        if signature != _THREADS_DB_SIGNATURE:
+            _THREADS_MEM.clear()
+            _THREADS_DB_SIGNATURE = signature
+        cached = _THREADS_MEM.get(wa_id)
+        if cached is not None:
+            _THREADS_MEM.move_to_end(wa_id)
+            return cached
+        pending = wa_id in _THREADS_PENDING
+
+    if pending:
+        # Pending writes are deltas; persist them so the read below includes them.
+        _flush_thread_writes([wa_id])
+    with _THREAD_DB_LOCK:
+        raw = thread_store.get_thread(wa_id)
+    if isinstance(raw, dict):
+        with _THREADS_MEM_LOCK:
+            if wa_id not in _THREADS_PENDING:
+                _remember_thread_payload(wa_id, raw)
+    return raw
+
+
+def _queue_thread_write(
+    wa_id: str, messages: List[Dict[str, Any]], fields: Dict[str, Any]
+) -> None:
+    """Merge an update into _THREADS_PENDING. Callers must hold _THREADS_MEM_LOCK."""
+    pending = _THREADS_PENDING.get(wa_id)
+    if pending is None:
+        _THREADS_PENDING[wa_id] = (list(messages), dict(fields))
+        return
+    pending[0].extend(messages)
+    pending[1].update(fields)
+
+
+def _flush_thread_writes(wa_ids: List[str] | None = None) -> None:
+    """Write pending thread states (all of them when wa_ids is None) to thread_store."""
+    global _THREADS_DB_SIGNATURE
+    with _THREAD_DB_LOCK:
+        with _THREADS_MEM_LOCK:
+            keys = list(_THREADS_PENDING) if wa_ids is None else wa_ids
+            batch = {
+                key: _THREADS_PENDING.pop(key)
+                for key in keys
+                if key in _THREADS_PENDING
+            }
+        if not batch:
+            return
+        before = thread_store.store_signature()
+        try:
+            thread_store.append_threads(batch)
+        except Exception:
+            logging.exception("Failed to persist %s thread state(s)", len(batch))
+            with _THREADS_MEM_LOCK:
+                for key, (messages, fields) in batch.items():
+                    newer = _THREADS_PENDING.pop(key, None)
+                    _queue_thread_write(key, messages, fields)
+                    if newer is not None:
+                        _queue_thread_write(key, *newer)
+            return
+        signature = thread_store.store_signature()
+        with _THREADS_MEM_LOCK:
+            # Someone else wrote since our last look; adopting the new signature
+            # would hide that, so drop the cache as _read_thread_payload would.
+            if before != _THREADS_DB_SIGNATURE:
+                _THREADS_MEM.clear()
+            _THREADS_DB_SIGNATURE = signature
+
+
+def _thread_writer_loop() -> None:
+    while True:
+        wa_ids = [_THREAD_WRITE_QUEUE.get()]
+        while len(wa_ids) < DEFAULT_THREAD_WRITE_BATCH:
+            try:
+                wa_ids.append(_THREAD_WRITE_QUEUE.get_nowait())
+            except Empty:
+                break
+        try:
+            _flush_thread_writes(wa_ids)
+        except Exception:
+            logging.exception("Thread store writer failed")
+
+
+def _ensure_thread_writer() -> None:
+    global _THREAD_WRITER
+    if _THREAD_WRITER is not None:
+        return
+    with _THREAD_WRITER_LOCK:
+        if _THREAD_WRITER is not None:
+            return
+        _THREAD_WRITER = Thread(
+            target=_thread_writer_loop, daemon=True, name="thread-store-writer"
+        )
+        _THREAD_WRITER.start()
+        atexit.register(_flush_thread_writes)
+
+
 def _load_thread_state(wa_id: str) -> Dict[str, Any]:
-    _ensure_thread_store_dir()
-    with shelve.open(THREADS_DB_PATH) as db:
-        raw = db.get(wa_id)
-    return _normalize_thread_state(raw)
+    return _normalize_thread_state(_read_thread_payload(wa_id))
 
 
 def _save_thread_state(wa_id: str, state: Dict[str, Any]) -> None:
-    payload = {
-        "messages": state.get("messages", []),
-        "ai_paused": bool(state.get("ai_paused")),
-        "handoff_reason": state.get("handoff_reason") or "",
-        "handoff_ts": state.get("handoff_ts") or "",
-        "seen_message_ids": state.get("seen_message_ids", []),
+    messages = state["messages"]
+    # New turns follow the stored tail; if the tail was trimmed away, all of them are new.
+    start = 0
+    tail = state.get("stored_tail")
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index] is tail:
+            start = index + 1
+            break
+    appended = messages[start:]
+    # Older turns stay in thread_store's archive; the live state keeps a bounded window.
+    if thread_store.HOT_MESSAGE_LIMIT > 0:
+        del messages[: -thread_store.HOT_MESSAGE_LIMIT]
+    state["stored_tail"] = messages[-1] if messages else None
+    fields = {
+        "seen_message_ids": list(state.get("seen_message_ids", [])),
+        "recent_queries": [list(entry) for entry in state.get("recent_queries", [])],
     }
-    _ensure_thread_store_dir()
-    with shelve.open(THREADS_DB_PATH) as db:
-        db[wa_id] = payload
+    flags = _thread_flags(state)
+    payload = dict(
+        fields,
+        messages=list(messages),
+        ai_paused=flags[0],
+        handoff_reason=flags[1],
+        handoff_ts=flags[2],
+    )
+    # Flags are written only when this turn changed them (e.g. a handoff), so a pause or
+    # resume from the dashboard that lands before the flush is not reverted.
+    if flags != state.get("stored_flags"):
+        fields.update(ai_paused=flags[0], handoff_reason=flags[1], handoff_ts=flags[2])
+        state["stored_flags"] = flags
+    with _THREADS_MEM_LOCK:
+        _queue_thread_write(wa_id, appended, fields)
+        _remember_thread_payload(wa_id, payload)
+    _ensure_thread_writer()
+    _THREAD_WRITE_QUEUE.put(wa_id)
 
 
 def pause_thread_for_manual_message(
@@ -979,20 +1855,10 @@ def pause_thread_for_manual_message(
 def _guard_message_length(cleaned_body: str, wa_id: str) -> str | None:
     """Return early message if the input fails length checks; otherwise None."""
     if len(cleaned_body) < DEFAULT_MIN_MSG_LENGTH:
-        message = dedent(
-            """
-            Mohon maaf, pesan Anda perlu lebih dari 20 karakter ya. 
-            Silakan tambahkan sedikit penjelasan atau kata kunci agar saya bisa membantu dengan lebih tepat. 🙂
-            """
-        ).strip()
+        message = MESSAGE_TOO_SHORT_RESPONSE
         return _log_and_reply(wa_id, cleaned_body, message)
     if len(cleaned_body) > DEFAULT_MAX_MSG_LENGTH:
-        message = dedent(
-            """
-            Mohon maaf, pesan Anda terlalu panjang. 
-            Silakan kirim pesan yang lebih singkat agar saya dapat memprosesnya dengan baik. 🙂
-            """
-        ).strip()
+        message = MESSAGE_TOO_LONG_RESPONSE
         return _log_and_reply(wa_id, cleaned_body, message)
     return None
 
@@ -1143,7 +2009,7 @@ def generate_response(message_body: str, wa_id: str, message_id: str | None = No
             return injection_guard_reply
 
         _ensure_vault_ready()
-        if _VAULT_EMB is None or _VAULT_CONTENT is None:
+        if _VAULT_EMB_NORM is None or _VAULT_CONTENT is None:
             logging.error("Vault embeddings not available; skipping automated reply.")
             return "Maaf, sedang ada gangguan pada sistem kami. Coba lagi sebentar ya."
 
@@ -1156,14 +2022,21 @@ def generate_response(message_body: str, wa_id: str, message_id: str | None = No
 
         if _is_duplicate_message(message_id, state):
             logging.info("Skipping duplicate/old message %s for %s", message_id, wa_id)
-            _save_thread_state(wa_id, state)
             return ""
 
         paused_reply = _handle_ai_paused(state, cleaned_body, wa_id, timestamp)
         if paused_reply is not None:
             return paused_reply
 
-        combined_checks = _run_combined_checks(
+        # The query embedding does not depend on the classifier, so request both at once
+        # (unless this thread already retrieved context for the same question).
+        recent_key = _recent_query_key(
+            message_body, DEFAULT_EMBED_MODEL, DEFAULT_TOP_K, DEFAULT_MIN_SIMILARITY
+        )
+        query_embedding = None
+        if _lookup_recent_context(state["recent_queries"], recent_key) is None:
+            query_embedding = _prefetch_query_embedding(message_body, DEFAULT_EMBED_MODEL)
+        combined_checks = _fast_classify(cleaned_body) or _run_combined_checks(
             cleaned_body,
             user_history_text,
             model=DEFAULT_GEN_MODEL,
@@ -1187,14 +2060,16 @@ def generate_response(message_body: str, wa_id: str, message_id: str | None = No
             answer = chat_with_rag(
                 user_input=message_body,
                 system_message=system_message,
-                vault_embeddings=_VAULT_EMB,
-                vault_embeddings_norm=_VAULT_EMB_NORM,
+                vault_embeddings=_VAULT_EMB_NORM,
+                vault_scale=_VAULT_EMB_SCALE,
                 vault_content=_VAULT_CONTENT,
                 ollama_model=DEFAULT_GEN_MODEL,
                 embed_model=DEFAULT_EMBED_MODEL,
                 conversation_history=history,
                 user_entry=user_entry,
                 precomputed_checks=combined_checks,
+                query_embedding=query_embedding,
+                recent_queries=state["recent_queries"],
                 top_k=DEFAULT_TOP_K,
                 min_similarity=DEFAULT_MIN_SIMILARITY,
                 num_ctx=DEFAULT_NUM_CTX,
@@ -1,8 +1,11 @@
 import logging
-import shelve
+import sqlite3
+import sys
+import time
 from contextlib import contextmanager
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from typing import Tuple
 
 from flask import (
     Blueprint,
@@ -14,40 +17,52 @@ from flask import (
     url_for,
 )
 
-from app.utils.whatsapp_utils import (
-    get_text_message_input,
-    send_message,
-    normalize_wa_id,
-    _simulate_human_typing
-)
-from app.services import contact_store
-from app.services.contact_store import upsert_contact
+from app.utils.whatsapp_utils import normalize_wa_id, routing_cache_stats
+from app.services import contact_store, thread_store
+from app.services.whatsapp_queue import enqueue_outbound_text, start_whatsapp_workers
+from app.services.contact_store import get_contact, upsert_contact
 from app.config import load_configurations, configure_logging
 
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 TEMPLATES_DIR = PROJECT_ROOT / "templates"
 STATIC_DIR = PROJECT_ROOT / "static"
-DB_BASENAME = PROJECT_ROOT / "threads_db_store" / "threads_db"
 
 history_blueprint = Blueprint(
     "conversation_history", __name__, template_folder=str(TEMPLATES_DIR)
 )
 
-DEFAULT_THREAD_STATE = {
-    "messages": [],
-    "ai_paused": False,
-    "handoff_reason": "",
-    "handoff_ts": "",
-}
 MANUAL_MESSAGE_ROLE = "operator"
 WIB = timezone(timedelta(hours=7))
 
 
+# (epoch second, formatted) of the last call; timestamps have one-second resolution,
+# so calls within the same second reuse the string.
+_LAST_TIMESTAMP: Tuple[int, str] = (-1, "")
+
+
 def _timestamp() -> str:
-    return datetime.now(WIB).isoformat(timespec="seconds")
+    global _LAST_TIMESTAMP
+    second = int(time.time())
+    cached_second, formatted = _LAST_TIMESTAMP
+    if cached_second != second:
+        formatted = datetime.fromtimestamp(second, WIB).isoformat(timespec="seconds")
+        _LAST_TIMESTAMP = (second, formatted)
+    return formatted
 
 
 def _coerce_message(raw) -> dict:
+    # Rows from thread_store are already well-formed; reuse them instead of copying.
+    if (
+        isinstance(raw, dict)
+        and len(raw) == 4
+        and isinstance(raw.get("ai_readable"), bool)
+        and isinstance(raw.get("content"), str)
+        and isinstance(raw.get("role"), str)
+        and isinstance(raw.get("timestamp"), str)
+        and raw["role"].strip() == raw["role"] != ""
+        and raw["timestamp"]
+    ):
+        return raw
     if isinstance(raw, dict):
         role = (raw.get("role") or "unknown").strip() or "unknown"
         content = str(raw.get("content") or "")
@@ -67,10 +82,15 @@ def _coerce_message(raw) -> dict:
 
 
 def _coerce_thread_state(wa_id: str, raw) -> dict:
-    state = dict(DEFAULT_THREAD_STATE)
-    state["wa_id"] = wa_id
+    state = {
+        "wa_id": wa_id,
+        "messages": [],
+        "ai_paused": False,
+        "handoff_reason": "",
+        "handoff_ts": "",
+    }
     if isinstance(raw, dict):
-        state["ai_paused"] = bool(raw.get("ai_paused", state["ai_paused"]))
+        state["ai_paused"] = bool(raw.get("ai_paused", False))
         state["handoff_reason"] = str(raw.get("handoff_reason") or "")
         state["handoff_ts"] = str(raw.get("handoff_ts") or "")
         messages = raw.get("messages", [])
@@ -82,46 +102,57 @@ def _coerce_thread_state(wa_id: str, raw) -> dict:
     return state
 
 
-@contextmanager
-def _open_thread_store(flag: str = "c"):
-    """
-    Open the threads_db shelf. Rely on the default dbm (gdbm on Debian-based images),
-    which keeps a single threads_db file instead of multiple dumb-db artifacts.
-    """
-    DB_BASENAME.parent.mkdir(parents=True, exist_ok=True)
-    db = shelve.open(str(DB_BASENAME), flag=flag)
-    try:
-        yield db
-    finally:
-        db.close()
+def _load_thread_state(wa_id: str, include_archived: bool = False) -> dict:
+    return _coerce_thread_state(wa_id, thread_store.get_thread(wa_id, include_archived))
 
 
-def _load_thread_state(wa_id: str) -> dict:
-    with _open_thread_store() as db:
-        return _coerce_thread_state(wa_id, db.get(wa_id))
+def _wants_archived_history() -> bool:
+    """Dashboard views include archived (trimmed) messages only when asked: ?history=all."""
+    return (request.args.get("history") or "").strip().lower() == "all"
 
 
-def _save_thread_state(wa_id: str, state: dict) -> None:
-    payload = {
-        "messages": state.get("messages", []),
-        "ai_paused": bool(state.get("ai_paused")),
-        "handoff_reason": state.get("handoff_reason") or "",
-        "handoff_ts": state.get("handoff_ts") or "",
-    }
-    with _open_thread_store() as db:
-        db[wa_id] = payload
+@contextmanager
+def _thread_txn(wa_id: str):
+    """
+    Yield (state, commit) for wa_id inside one write transaction; commit(state) stores it.
+    Fields the dashboard does not manage (e.g. seen message ids) are kept as stored.
+    """
+    with thread_store.thread_transaction(wa_id) as (raw, write):
+        def commit(state: dict) -> None:
+            if thread_store.HOT_MESSAGE_LIMIT > 0:
+                del state["messages"][: -thread_store.HOT_MESSAGE_LIMIT]
+            payload = dict(raw) if isinstance(raw, dict) else {}
+            payload.update(
+                {
+                    "messages": state.get("messages", []),
+                    "ai_paused": bool(state.get("ai_paused")),
+                    "handoff_reason": state.get("handoff_reason") or "",
+                    "handoff_ts": state.get("handoff_ts") or "",
+                }
+            )
+            write(payload)
+
+        yield _coerce_thread_state(wa_id, raw), commit
 
 
 def load_conversations():
+    """
+    Contact list for the dashboard: thread flags plus the message count and last message.
+    Full histories are loaded per thread with _load_thread_state.
+    """
     try:
-        with _open_thread_store(flag="c") as db:
-            conversations = [
-                _coerce_thread_state(wa_id, history) for wa_id, history in db.items()
-            ]
-    except (FileNotFoundError, OSError) as exc:
-        logging.warning("Unable to open conversation store %s: %s", DB_BASENAME, exc)
+        summaries = thread_store.list_thread_summaries()
+    except (sqlite3.Error, OSError) as exc:
+        logging.warning(
+            "Unable to open conversation store %s: %s", thread_store.THREADS_DB_PATH, exc
+        )
         return []
-    conversations.sort(key=lambda item: item["wa_id"])
+    conversations = []
+    for wa_id, flags, message_count, last_message in summaries:
+        state = _coerce_thread_state(wa_id, flags)
+        state["message_count"] = message_count
+        state["last_message"] = _coerce_message(last_message) if last_message else None
+        conversations.append(state)
     return conversations
 
 
@@ -131,8 +162,9 @@ def _load_contacts_store() -> list[dict]:
     """
     try:
         # Reuse the contact_store helpers to keep normalization consistent.
+        # Copy under the lock: the cached store is updated in place by writers.
         with contact_store._STORE_LOCK:  # noqa: SLF001
-            store = contact_store._load_store()  # noqa: SLF001
+            store = dict(contact_store._load_store())  # noqa: SLF001
     except Exception as exc:  # noqa: BLE001
         logging.warning(
             "Unable to read contact store %s: %s",
@@ -156,15 +188,15 @@ def _load_contacts_store() -> list[dict]:
 @history_blueprint.route("/")
 def history_index():
     contacts = load_conversations()
+    show_archived = _wants_archived_history()
     selected_wa_id = normalize_wa_id(request.args.get("wa_id") or "")
     selected_contact = None
 
     for contact in contacts:
-        messages = contact["messages"]
+        last = contact["last_message"]
         last_text = ""
         last_role = ""
-        if messages:
-            last = messages[-1]
+        if last:
             last_text = (last.get("content") or "").strip()
             last_role = (last.get("role") or "message").capitalize()
         contact["last_text"] = last_text
@@ -176,7 +208,15 @@ def history_index():
         selected_contact = contacts[0]
         selected_wa_id = selected_contact["wa_id"]
 
-    selected_messages = selected_contact["messages"] if selected_contact else []
+    selected_messages = []
+    if selected_contact:
+        try:
+            selected_contact["messages"] = _load_thread_state(
+                selected_wa_id, include_archived=show_archived
+            )["messages"]
+        except (sqlite3.Error, OSError) as exc:
+            logging.warning("Unable to load thread state for %s: %s", selected_wa_id, exc)
+        selected_messages = selected_contact["messages"]
     contact_store_records = _load_contacts_store()
     return render_template(
         "history_view.html",
@@ -184,7 +224,8 @@ def history_index():
         selected_contact=selected_contact,
         selected_wa_id=selected_wa_id,
         selected_messages=selected_messages,
-        db_path=DB_BASENAME.resolve(),
+        show_archived=show_archived,
+        db_path=thread_store.THREADS_DB_PATH.resolve(),
         contact_store_records=contact_store_records,
         contact_store_path=contact_store.CONTACT_STORE_PATH.resolve(),
         status_message=request.args.get("status"),
@@ -198,8 +239,8 @@ def history_feed(wa_id: str):
     if not wa_id:
         return jsonify({"error": "WhatsApp number is required."}), 400
     try:
-        state = _load_thread_state(wa_id)
-    except OSError as exc:
+        state = _load_thread_state(wa_id, include_archived=_wants_archived_history())
+    except (sqlite3.Error, OSError) as exc:
         logging.warning("Unable to load thread state for %s: %s", wa_id, exc)
         state = _coerce_thread_state(wa_id, [])
     return jsonify(
@@ -214,6 +255,19 @@ def history_feed(wa_id: str):
     )
 
 
+@history_blueprint.route("/debug/cache")
+def cache_stats():
+    # Only report when the bot runs in this process; importing it here would load the
+    # embedding stack into a dashboard-only server.
+    rag = sys.modules.get("app.services.rag_ollama_whatsapp")
+    return jsonify(
+        {
+            "classifier": rag.classifier_cache_stats() if rag is not None else None,
+            "routing": routing_cache_stats(),
+        }
+    )
+
+
 @history_blueprint.route("/send", methods=["POST"])
 def send_manual_message():
     wa_id = normalize_wa_id(request.form.get("wa_id") or "")
@@ -236,39 +290,6 @@ def send_manual_message():
             )
         )
 
-    payload = get_text_message_input(wa_id, message)
-    logging.info("Manual send triggered for %s", wa_id)
-    _simulate_human_typing(wa_id)
-    result = send_message(payload)
-
-    status_code = None
-    error_detail = None
-
-    if isinstance(result, tuple):
-        response_obj, status_code = result
-        try:
-            error_json = response_obj.get_json()
-        except Exception:  # noqa: BLE001
-            error_json = None
-        if error_json and error_json.get("message"):
-            error_detail = error_json["message"]
-            if error_json.get("detail"):
-                error_detail += f" ({error_json['detail']})"
-    elif hasattr(result, "status_code"):
-        status_code = result.status_code
-
-    if status_code is not None and status_code >= 400:
-        message_suffix = f"(status {status_code})"
-        if error_detail:
-            message_suffix += f": {error_detail}"
-        return redirect(
-            url_for(
-                "conversation_history.history_index",
-                wa_id=wa_id,
-                error=f"Failed to send message {message_suffix}. Check server logs for details.",
-            )
-        )
-
     manual_entry = {
         "role": MANUAL_MESSAGE_ROLE,
         "content": message,
@@ -276,22 +297,21 @@ def send_manual_message():
         "ai_readable": False,
     }
     try:
-        state = _load_thread_state(wa_id)
-    except OSError as exc:
-        logging.warning("Unable to load thread state for %s: %s", wa_id, exc)
-        state = _coerce_thread_state(wa_id, [])
-    state["messages"].append(manual_entry)
-
-    try:
-        _save_thread_state(wa_id, state)
-    except OSError as exc:
+        with _thread_txn(wa_id) as (state, commit):
+            state["messages"].append(manual_entry)
+            commit(state)
+    except (sqlite3.Error, OSError) as exc:
         logging.warning("Failed to persist manual message for %s: %s", wa_id, exc)
 
+    # Delivery (typing indicator, then the send) runs on the chat's queue worker.
+    logging.info("Manual send queued for %s", wa_id)
+    enqueue_outbound_text(wa_id, message)
+
     return redirect(
         url_for(
             "conversation_history.history_index",
             wa_id=wa_id,
-            status=f"Message sent to {wa_id}.",
+            status=f"Message queued for {wa_id}.",
         )
     )
 
@@ -310,34 +330,56 @@ def toggle_ai():
             )
         )
 
+    # Repeated clicks: skip the notice, contact update and write when nothing would change.
+    pausing = action != "resume"
+    try:
+        current = _load_thread_state(wa_id)
+        contact = get_contact(wa_id)
+    except Exception as exc:  # noqa: BLE001
+        logging.debug("Unable to check automation state for %s: %s", wa_id, exc)
+    else:
+        contact_allows_bot = contact.get("allow_bot", True) if contact else True
+        if current["ai_paused"] == pausing and contact_allows_bot != pausing:
+            return redirect(
+                url_for(
+                    "conversation_history.history_index",
+                    wa_id=wa_id,
+                    status=(
+                        f"Automation is already paused for {wa_id}."
+                        if pausing
+                        else f"Automation is already active for {wa_id}."
+                    ),
+                )
+            )
+
     timestamp = _timestamp()
 
-    with _open_thread_store() as db:
-        state = _coerce_thread_state(wa_id, db.get(wa_id))
+    if action == "resume":
+        system_note = "Terima kasih sudah berbicara dengan tim Optimaxx. Sekarang balasan otomatis/Asisten Virtual Optimaxx telah diaktifkan kembali. 😊"
+        enqueue_outbound_text(wa_id, system_note)
+        upsert_contact(
+            wa_id,
+            allow_bot=True,
+            source="dashboard_toggle",
+        )
+    else:
+        system_note = (
+            "Balasan otomatis telah dijeda secara manual oleh tim Optimaxx."
+        )
+        enqueue_outbound_text(wa_id, system_note)
+        upsert_contact(
+            wa_id,
+            allow_bot=False,
+            source="dashboard_toggle",
+        )
+    # Messaging and the contact update above stay outside the write transaction.
+    with _thread_txn(wa_id) as (state, commit):
         if action == "resume":
             state["ai_paused"] = False
             state["handoff_reason"] = ""
-            system_note = "Terima kasih sudah berbicara dengan tim Optimaxx. Sekarang balasan otomatis/Asisten Virtual Optimaxx telah diaktifkan kembali. 😊"
-            _simulate_human_typing(wa_id)
-            send_message(get_text_message_input(wa_id, system_note))
-            upsert_contact(
-                wa_id,
-                allow_bot=True,
-                source="dashboard_toggle",
-            )
         else:
             state["ai_paused"] = True
             state["handoff_reason"] = reason or "Paused from dashboard"
-            system_note = (
-                "Balasan otomatis telah dijeda secara manual oleh tim Optimaxx."
-            )
-            _simulate_human_typing(wa_id)
-            send_message(get_text_message_input(wa_id, system_note))
-            upsert_contact(
-                wa_id,
-                allow_bot=False,
-                source="dashboard_toggle",
-            )
         state["handoff_ts"] = timestamp
         state["messages"].append(
             {
@@ -347,12 +389,7 @@ def toggle_ai():
                 "ai_readable": False,
             }
         )
-        db[wa_id] = {
-            "messages": state["messages"],
-            "ai_paused": state["ai_paused"],
-            "handoff_reason": state["handoff_reason"],
-            "handoff_ts": state["handoff_ts"],
-        }
+        commit(state)
 
     status_message = (
         f"Automation resumed for {wa_id}."
@@ -414,4 +451,6 @@ def create_app(url_prefix: str = ""):
     load_configurations(app)
     configure_logging()
     app.register_blueprint(history_blueprint, url_prefix=url_prefix)
+    # Manual sends and automation notices are delivered by the queue workers.
+    start_whatsapp_workers(app, 1)
     return app
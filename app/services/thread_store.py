@@ -0,0 +1,431 @@
+import logging
+import os
+import shelve
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from queue import Empty, Queue
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from app.utils import fast_json
+
+PROJECT_ROOT = Path(__file__).resolve().parents[2]
+THREADS_STORE_DIR = PROJECT_ROOT / "threads_db_store"
+THREADS_DB_PATH = THREADS_STORE_DIR / "threads.sqlite3"
+# Pre-SQLite shelf; its records are copied over when the database is still empty.
+LEGACY_SHELF_PATH = THREADS_STORE_DIR / "threads_db"
+_LEGACY_SHELF_SUFFIXES = ("", ".db", ".dat", ".dir")
+
+# threads holds one metadata payload per conversation, plus copies of the handoff flags
+# as columns so the dashboard can list threads without decoding payloads; messages holds
+# its turns, one row each, so a new turn is an INSERT instead of re-serializing it all.
+# put_threads lines the new message list up with the stored rows: the longest matching run
+# is kept, rows after it are replaced and only the new tail is inserted. Rows dropped from
+# the front of the list are not deleted: threads.hot_start moves past them and they stay
+# readable as archived history (include_archived=True). append_threads only adds rows and
+# updates the payload fields it is given, so it never overwrites a concurrent edit.
+_SCHEMA_VERSION = 3
+# Messages kept in a thread's live state; older ones are left to the archive.
+HOT_MESSAGE_LIMIT = int(os.getenv("WHATSAPP_HOT_MESSAGES", "50"))
+_THREAD_COLUMNS = (
+    ("ai_paused", "INTEGER NOT NULL DEFAULT 0"),
+    ("handoff_reason", "TEXT NOT NULL DEFAULT ''"),
+    ("handoff_ts", "TEXT NOT NULL DEFAULT ''"),
+    ("hot_start", "INTEGER NOT NULL DEFAULT 0"),
+)
+
+# Idle connections, borrowed for one operation at a time. Dashboard requests run on
+# short-lived threads, so per-thread connections would reopen the database per request.
+# WAL lets readers proceed while another connection writes.
+_POOL: "Queue[sqlite3.Connection]" = Queue()
+_SCHEMA_LOCK = threading.Lock()
+_SCHEMA_READY = False
+
+
+def _open_connection() -> sqlite3.Connection:
+    THREADS_STORE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(
+        str(THREADS_DB_PATH), timeout=30.0, isolation_level=None, check_same_thread=False
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def _message_fields(message: Any) -> Tuple[str, str, str, int]:
+    if not isinstance(message, dict):
+        return ("", str(message), "", 1)
+    return (
+        str(message.get("role") or ""),
+        str(message.get("content") or ""),
+        str(message.get("timestamp") or ""),
+        int(bool(message.get("ai_readable", True))),
+    )
+
+
+def _message_from_row(role: str, content: str, timestamp: str, ai_readable: int) -> Dict[str, Any]:
+    return {
+        "role": role,
+        "content": content,
+        "timestamp": timestamp,
+        "ai_readable": bool(ai_readable),
+    }
+
+
+def _stored_overlap(stored: List[Tuple[Any, ...]], fields: List[Tuple[Any, ...]]) -> Tuple[int, int]:
+    """
+    (start, kept) such that stored[start:start + kept] == fields[:kept]. A run reaching the
+    last stored row wins, smallest start first: rows before start were trimmed from the
+    head and the rest of fields is new. Otherwise the longest run, smallest start first;
+    the stored rows after it were edited or removed. (0, 0) when nothing lines up.
+    """
+    best = (0, 0)
+    if not fields:
+        return best
+    first = fields[0]
+    for start, row in enumerate(stored):
+        if row != first:
+            continue
+        limit = min(len(stored) - start, len(fields))
+        kept = 1
+        while kept < limit and stored[start + kept] == fields[kept]:
+            kept += 1
+        if start + kept == len(stored):
+            return start, kept
+        if kept > best[1]:
+            best = (start, kept)
+    return best
+
+
+def _next_seq(conn: sqlite3.Connection, wa_id: str) -> int:
+    last_seq = conn.execute(
+        "SELECT MAX(seq) FROM messages WHERE wa_id = ?", (wa_id,)
+    ).fetchone()[0]
+    return 0 if last_seq is None else last_seq + 1
+
+
+def _thread_row(wa_id: str, meta: Dict[str, Any], hot_start: int) -> Tuple[Any, ...]:
+    return (
+        wa_id,
+        fast_json.dumps(meta),
+        int(bool(meta.get("ai_paused"))),
+        str(meta.get("handoff_reason") or ""),
+        str(meta.get("handoff_ts") or ""),
+        hot_start,
+    )
+
+
+def _write_rows(
+    conn: sqlite3.Connection,
+    thread_rows: List[Tuple[Any, ...]],
+    message_rows: List[Tuple[Any, ...]],
+) -> None:
+    conn.executemany(
+        "INSERT OR REPLACE INTO threads "
+        "(wa_id, payload, ai_paused, handoff_reason, handoff_ts, hot_start) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        thread_rows,
+    )
+    conn.executemany(
+        "INSERT INTO messages (wa_id, seq, role, content, timestamp, ai_readable) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        message_rows,
+    )
+
+
+def _store_payloads(conn: sqlite3.Connection, payloads: Dict[str, Any]) -> None:
+    """Write payloads inside the caller's transaction."""
+    thread_rows = []
+    message_rows = []
+    for wa_id, payload in payloads.items():
+        if isinstance(payload, dict):
+            messages = payload.get("messages") or []
+            meta = {key: value for key, value in payload.items() if key != "messages"}
+        else:
+            messages = payload if isinstance(payload, list) else []
+            meta = {}
+        fields = [_message_fields(message) for message in messages]
+        thread = conn.execute(
+            "SELECT hot_start FROM threads WHERE wa_id = ?", (wa_id,)
+        ).fetchone()
+        stored_rows = conn.execute(
+            "SELECT seq, role, content, timestamp, ai_readable FROM messages "
+            "WHERE wa_id = ? AND seq >= ? ORDER BY seq",
+            (wa_id, thread[0] if thread else 0),
+        ).fetchall()
+        start, kept = _stored_overlap([tuple(row[1:]) for row in stored_rows], fields)
+        if start + kept < len(stored_rows):
+            conn.execute(
+                "DELETE FROM messages WHERE wa_id = ? AND seq >= ?",
+                (wa_id, stored_rows[start + kept][0]),
+            )
+        next_seq = _next_seq(conn, wa_id)
+        hot_start = stored_rows[start][0] if kept else next_seq
+        message_rows.extend(
+            (wa_id, next_seq + offset, *row) for offset, row in enumerate(fields[kept:])
+        )
+        thread_rows.append(_thread_row(wa_id, meta, hot_start))
+    _write_rows(conn, thread_rows, message_rows)
+
+
+def _append_payloads(
+    conn: sqlite3.Connection, updates: Dict[str, Tuple[List[Any], Dict[str, Any]]]
+) -> None:
+    """Append messages and update payload fields inside the caller's transaction."""
+    thread_rows = []
+    message_rows = []
+    for wa_id, (messages, fields) in updates.items():
+        row = conn.execute(
+            "SELECT payload, hot_start FROM threads WHERE wa_id = ?", (wa_id,)
+        ).fetchone()
+        meta = _decode_payload(wa_id, row[0]) if row else None
+        if not isinstance(meta, dict):
+            meta = {}
+        meta.update(fields)
+        next_seq = _next_seq(conn, wa_id)
+        message_rows.extend(
+            (wa_id, next_seq + offset, *_message_fields(message))
+            for offset, message in enumerate(messages)
+        )
+        hot_start = row[1] if row else 0
+        if HOT_MESSAGE_LIMIT > 0:
+            hot_start = max(hot_start, next_seq + len(messages) - HOT_MESSAGE_LIMIT)
+        thread_rows.append(_thread_row(wa_id, meta, hot_start))
+    _write_rows(conn, thread_rows, message_rows)
+
+
+def _upgrade_schema(conn: sqlite3.Connection) -> None:
+    """
+    Bring older databases up to _SCHEMA_VERSION: move messages embedded in thread payloads
+    (version 0) into the messages table and fill the columns added in versions 2 and 3.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(threads)")}
+        for name, definition in _THREAD_COLUMNS:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE threads ADD COLUMN {name} {definition}")
+        payloads = {}
+        for wa_id, raw in conn.execute("SELECT wa_id, payload FROM threads").fetchall():
+            payload = _decode_payload(wa_id, raw)
+            if isinstance(payload, dict) and "messages" not in payload:
+                payload = _read_thread(conn, wa_id)
+            payloads[wa_id] = payload
+        _store_payloads(conn, payloads)
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _legacy_shelf_exists() -> bool:
+    return any(
+        Path(f"{LEGACY_SHELF_PATH}{suffix}").is_file() for suffix in _LEGACY_SHELF_SUFFIXES
+    )
+
+
+def _migrate_legacy_shelf(conn: sqlite3.Connection) -> None:
+    """Copy threads from the old shelve store into an empty database."""
+    if not _legacy_shelf_exists():
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM threads LIMIT 1").fetchone() is None:
+            payloads = {}
+            with shelve.open(str(LEGACY_SHELF_PATH), flag="r") as db:
+                for wa_id in list(db.keys()):
+                    try:
+                        payloads[wa_id] = fast_json.loads(fast_json.dumps(db[wa_id]))
+                    except Exception as exc:
+                        logging.warning("Skipping thread %s during migration: %s", wa_id, exc)
+            _store_payloads(conn, payloads)
+            if payloads:
+                logging.info(
+                    "Migrated %s thread(s) from %s", len(payloads), LEGACY_SHELF_PATH
+                )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        logging.exception("Failed to migrate legacy thread shelf %s", LEGACY_SHELF_PATH)
+
+
+def _ensure_schema(conn: sqlite3.Connection) -> None:
+    global _SCHEMA_READY
+    if _SCHEMA_READY:
+        return
+    with _SCHEMA_LOCK:
+        if _SCHEMA_READY:
+            return
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads (wa_id TEXT PRIMARY KEY, payload BLOB NOT NULL, "
+            + ", ".join(f"{name} {definition}" for name, definition in _THREAD_COLUMNS)
+            + ")"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "wa_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+            "content TEXT NOT NULL, timestamp TEXT NOT NULL, ai_readable INTEGER NOT NULL, "
+            "PRIMARY KEY (wa_id, seq)) WITHOUT ROWID"
+        )
+        if conn.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+            _upgrade_schema(conn)
+        _migrate_legacy_shelf(conn)
+        _SCHEMA_READY = True
+
+
+@contextmanager
+def _connection() -> Iterator[sqlite3.Connection]:
+    try:
+        conn = _POOL.get_nowait()
+    except Empty:
+        conn = _open_connection()
+        _ensure_schema(conn)
+    try:
+        yield conn
+    finally:
+        _POOL.put(conn)
+
+
+def _decode_payload(wa_id: str, raw: bytes) -> Any:
+    try:
+        return fast_json.loads(raw)
+    except fast_json.JSONDecodeError as exc:
+        logging.warning("Ignoring unreadable thread state for %s: %s", wa_id, exc)
+        return None
+
+
+def store_signature() -> Tuple[int, ...]:
+    """
+    (st_mtime_ns, st_size) of the database and its WAL file, zeros when missing.
+    Changes whenever any process commits, so callers can drop stale caches.
+    """
+    signature: List[int] = []
+    for suffix in ("", "-wal"):
+        try:
+            stat = os.stat(f"{THREADS_DB_PATH}{suffix}")
+        except OSError:
+            signature.extend((0, 0))
+            continue
+        signature.extend((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _read_thread(conn: sqlite3.Connection, wa_id: str, include_archived: bool = False) -> Any:
+    """Read one thread inside the caller's transaction."""
+    row = conn.execute(
+        "SELECT payload, hot_start FROM threads WHERE wa_id = ?", (wa_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    message_rows = conn.execute(
+        "SELECT role, content, timestamp, ai_readable FROM messages "
+        "WHERE wa_id = ? AND seq >= ? ORDER BY seq",
+        (wa_id, 0 if include_archived else row[1]),
+    ).fetchall()
+    payload = _decode_payload(wa_id, row[0])
+    if not isinstance(payload, dict):
+        payload = {}
+    payload["messages"] = [_message_from_row(*message) for message in message_rows]
+    return payload
+
+
+def get_thread(wa_id: str, include_archived: bool = False) -> Any:
+    """
+    Return the stored payload for wa_id, or None if there is none. Its messages are the
+    current ones, preceded by archived (trimmed) messages when include_archived is set.
+    """
+    with _connection() as conn:
+        conn.execute("BEGIN")
+        try:
+            return _read_thread(conn, wa_id, include_archived)
+        finally:
+            conn.execute("COMMIT")
+
+
+def list_thread_summaries() -> List[Tuple[str, Dict[str, Any], int, Dict[str, Any] | None]]:
+    """
+    Return (wa_id, flags, message_count, last_message) for every stored thread, ordered by
+    wa_id. flags holds ai_paused, handoff_reason and handoff_ts; message_count includes
+    archived messages. Reads indexed columns only, so listing stays cheap however long
+    the conversations get.
+    """
+    with _connection() as conn:
+        rows = conn.execute(
+            "SELECT t.wa_id, t.ai_paused, t.handoff_reason, t.handoff_ts, "
+            "(SELECT COUNT(*) FROM messages WHERE wa_id = t.wa_id), "
+            "m.role, m.content, m.timestamp, m.ai_readable "
+            "FROM threads AS t LEFT JOIN messages AS m ON m.wa_id = t.wa_id "
+            "AND m.seq = (SELECT MAX(seq) FROM messages WHERE wa_id = t.wa_id) "
+            "ORDER BY t.wa_id"
+        ).fetchall()
+    summaries = []
+    for wa_id, ai_paused, handoff_reason, handoff_ts, count, *last in rows:
+        flags = {
+            "ai_paused": bool(ai_paused),
+            "handoff_reason": handoff_reason,
+            "handoff_ts": handoff_ts,
+        }
+        last_message = _message_from_row(*last) if count else None
+        summaries.append((wa_id, flags, count, last_message))
+    return summaries
+
+
+def put_threads(payloads: Dict[str, Any]) -> None:
+    """Replace the stored payloads for several threads in a single transaction."""
+    if not payloads:
+        return
+    with _connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _store_payloads(conn, payloads)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def put_thread(wa_id: str, payload: Any) -> None:
+    put_threads({wa_id: payload})
+
+
+def append_threads(updates: Dict[str, Tuple[List[Any], Dict[str, Any]]]) -> None:
+    """
+    Apply (messages, fields) updates for several threads in a single transaction: append
+    the messages and set the given payload fields. Stored messages and fields left out
+    keep their values, so concurrent edits (e.g. from the dashboard) are not overwritten.
+    """
+    if not updates:
+        return
+    with _connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            _append_payloads(conn, updates)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def append_message(wa_id: str, entry: Any) -> None:
+    append_threads({wa_id: ([entry], {})})
+
+
+@contextmanager
+def thread_transaction(wa_id: str) -> Iterator[Tuple[Any, Callable[[Any], None]]]:
+    """
+    Yield (payload, write) for wa_id under one write transaction, so no other writer can
+    slip in between the read and write(new_payload). Commits on exit, rolls back on error.
+    Keep the block short: other writers wait for it.
+    """
+    with _connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            payload = _read_thread(conn, wa_id)
+            yield payload, lambda new_payload: _store_payloads(conn, {wa_id: new_payload})
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
@@ -1,46 +1,125 @@
 import logging
 from queue import Queue
-from threading import Thread
-from typing import Any, Dict
+from threading import Lock, Thread
+from typing import Any, Dict, List, Tuple
 
-_job_queue: "Queue[Dict[str, Any]]" = Queue()
+# Job kinds: an incoming WAHA webhook body, or a dashboard text to deliver.
+_WEBHOOK_JOB = "webhook"
+_OUTBOUND_JOB = "outbound"
+
+# One queue per worker. Jobs for the same chat always land on the same shard, so a
+# conversation is handled in order by a single worker and a slow reply only delays
+# the chats that share its shard.
+_shards: List["Queue[Tuple[str, Dict[str, Any]]]"] = [Queue()]
 _workers_started = False
+_workers_start_lock = Lock()
 
 
 def start_whatsapp_workers(app, num_workers: int = 1) -> None:
-    """Start background workers that process WhatsApp jobs from the shared queue."""
-    global _workers_started
+    """Start background workers, each draining its own shard of WhatsApp jobs."""
+    global _workers_started, _shards
     if _workers_started:
         return
+    with _workers_start_lock:
+        if _workers_started:
+            return
+
+        worker_count = max(1, int(num_workers or 1))
+        # Keep anything enqueued before the workers started.
+        pending = []
+        for shard in _shards:
+            while not shard.empty():
+                pending.append(shard.get_nowait())
+        _shards = [Queue() for _ in range(worker_count)]
+        for job in pending:
+            _put(_shards, job)
 
-    worker_count = max(1, int(num_workers or 1))
-    for idx in range(worker_count):
-        thread = Thread(
-            target=_worker_loop,
-            args=(app,),
-            daemon=True,
-            name=f"whatsapp-worker-{idx + 1}",
-        )
-        thread.start()
-    _workers_started = True
+        for idx, shard in enumerate(_shards):
+            thread = Thread(
+                target=_worker_loop,
+                args=(app, shard),
+                daemon=True,
+                name=f"whatsapp-worker-{idx + 1}",
+            )
+            thread.start()
+        _workers_started = True
     logging.info("Started %s WhatsApp worker(s).", worker_count)
 
 
+def _shard_key(payload: Dict[str, Any]) -> str:
+    """Chat the job belongs to: the recipient for our own messages, the sender otherwise."""
+    from app.utils.whatsapp_utils import normalize_wa_id
+
+    message = payload.get("payload") if isinstance(payload, dict) else None
+    if not isinstance(message, dict):
+        return ""
+    if message.get("fromMe"):
+        raw = message.get("to") or message.get("from")
+    else:
+        raw = message.get("from") or message.get("author")
+    return normalize_wa_id(str(raw or ""))
+
+
+def _enqueue(job: Tuple[str, Dict[str, Any]]) -> None:
+    if _workers_started:
+        _put(_shards, job)
+        return
+    # start_whatsapp_workers drains and replaces _shards under this lock; holding it keeps
+    # a job from landing in a queue that has already been drained.
+    with _workers_start_lock:
+        _put(_shards, job)
+
+
+def _put(
+    shards: List["Queue[Tuple[str, Dict[str, Any]]]"], job: Tuple[str, Dict[str, Any]]
+) -> None:
+    """Put job on the shard of shards that owns its chat."""
+    kind, payload = job
+    try:
+        if kind == _OUTBOUND_JOB:
+            from app.utils.whatsapp_utils import normalize_wa_id
+
+            key = normalize_wa_id(payload["chat_id"])
+        else:
+            key = _shard_key(payload)
+    except Exception:
+        key = ""
+    shards[hash(key) % len(shards)].put(job)
+
+
 def enqueue_whatsapp_job(payload: Dict[str, Any]) -> None:
-    """Push a WhatsApp webhook payload onto the queue."""
-    _job_queue.put(payload)
+    """Push a WhatsApp webhook payload onto the shard that owns its chat."""
+    _enqueue((_WEBHOOK_JOB, payload))
+
+
+def enqueue_outbound_text(chat_id: str, text: str) -> None:
+    """
+    Queue a text for chat_id; the chat's worker shows the typing indicator and hands it
+    to the typing sender, so the caller does not wait through the simulated delay.
+    """
+    _enqueue((_OUTBOUND_JOB, {"chat_id": chat_id, "text": text}))
+
+
+def _deliver_outbound_text(payload: Dict[str, Any]) -> None:
+    from app.utils.whatsapp_utils import _send_after_typing, get_text_message_input
+
+    chat_id = payload["chat_id"]
+    _send_after_typing(chat_id, get_text_message_input(chat_id, payload["text"]))
 
 
-def _worker_loop(app) -> None:
-    """Worker loop that drains the queue and processes each job."""
+def _worker_loop(app, shard: "Queue[Tuple[str, Dict[str, Any]]]") -> None:
+    """Worker loop that drains one shard and processes each job."""
     from app.utils.whatsapp_utils import process_whatsapp_message
 
     while True:
-        payload = _job_queue.get()
+        kind, payload = shard.get()
         try:
             with app.app_context():
-                process_whatsapp_message(payload)
+                if kind == _OUTBOUND_JOB:
+                    _deliver_outbound_text(payload)
+                else:
+                    process_whatsapp_message(payload)
         except Exception:
-            logging.exception("Failed to process WhatsApp message from queue")
+            logging.exception("Failed to process WhatsApp job from queue")
         finally:
-            _job_queue.task_done()
+            shard.task_done()
@@ -0,0 +1,68 @@
+"""
+Match text against a fixed set of regexes in one pass. Uses a Hyperscan database
+when the package is installed and a single re alternation otherwise.
+"""
+import re
+import threading
+from typing import Callable, List, Pattern, Sequence
+
+try:
+    import hyperscan
+except ImportError:  # hyperscan is an optional speedup; the regex path is used otherwise
+    hyperscan = None
+
+
+def _compile_database(sources: List[str]):
+    if hyperscan is None or not sources:
+        return None
+    flags = hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP
+    flags |= hyperscan.HS_FLAG_SINGLEMATCH
+    try:
+        database = hyperscan.Database()
+        database.compile(
+            expressions=[source.encode("utf-8") for source in sources],
+            ids=list(range(len(sources))),
+            flags=[flags] * len(sources),
+        )
+    except Exception:
+        return None
+    return database
+
+
+def _stop_on_match(pattern_id, start, end, flags, context) -> bool:
+    context.append(pattern_id)
+    return True  # non-zero return stops the scan at the first match
+
+
+def compile_any_matcher(patterns: Sequence[Pattern[str]]) -> Callable[[str], bool]:
+    """
+    Return a function reporting whether any of patterns matches a text (case-insensitive).
+    """
+    sources = [pattern.pattern for pattern in patterns]
+    regex = re.compile("|".join(f"(?:{source})" for source in sources), re.IGNORECASE)
+    database = _compile_database(sources)
+    if database is None:
+        return lambda text: regex.search(text) is not None
+
+    # Hyperscan scratch space must not be shared between concurrently scanning threads.
+    local = threading.local()
+
+    def matches(text: str) -> bool:
+        try:
+            data = text.encode("utf-8")
+        except UnicodeEncodeError:  # lone surrogates are not valid input for a UTF-8 database
+            return regex.search(text) is not None
+        scratch = getattr(local, "scratch", None)
+        if scratch is None:
+            scratch = local.scratch = hyperscan.Scratch(database)
+        hits: list = []
+        try:
+            database.scan(
+                data, match_event_handler=_stop_on_match, context=hits, scratch=scratch
+            )
+        except hyperscan.error:
+            if not hits:
+                return regex.search(text) is not None
+        return bool(hits)
+
+    return matches
@@ -1,27 +1,36 @@
-import json
+import hashlib
+import heapq
+import itertools
 import logging
 import os
 import random
 import re
 import time
 from collections import OrderedDict
+from queue import Empty, Queue
+from concurrent.futures import Future, ThreadPoolExecutor
 from textwrap import dedent
-from threading import Lock, Timer
-from typing import Any, Dict
+from threading import Condition, Lock, Thread
+from typing import Any, Dict, List, Set, Tuple
 
-import ollama
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import current_app, jsonify
 
 from app.services.contact_store import (
     DEFAULT_UNKNOWN_CATEGORY,
     ensure_contact_record,
-    get_contact,
+    get_contacts_many,
     upsert_contact,
 )
+from app.utils import fast_json
 from app.services.rag_ollama_whatsapp import (
+    DEFAULT_CLASSIFIER_NUM_CTX,
     DEFAULT_GEN_MODEL,
+    DEFAULT_OLLAMA_KEEP_ALIVE,
     generate_response,
+    get_ollama_client,
     pause_thread_for_manual_message,
 )
 
@@ -144,38 +153,125 @@ ROUTING_CLASSIFIER_PROMPT = dedent(
     """
 ).strip()
 
-_CHAT_ID_CACHE: Dict[str, str] = {}
+# WAHA chat id (…@c.us / …@lid / …@g.us) by bare id, most recently used last.
+_CHAT_ID_CACHE: "OrderedDict[str, str]" = OrderedDict()
+_CHAT_ID_CACHE_LOCK = Lock()
+_CHAT_ID_CACHE_MAX = 4096
 _DEBOUNCE_LOCK = Lock()
 _DEBOUNCE_BUFFERS: Dict[str, Dict[str, Any]] = {}
+# Debounce deadlines as (due, epoch, key) heap entries, watched by one scheduler thread.
+# Each new message gives its buffer a fresh epoch, so older entries for the key are
+# skipped when they come due; cancelling a buffer just drops it from _DEBOUNCE_BUFFERS.
+_DEBOUNCE_HEAP: List[Tuple[float, int, str]] = []
+_DEBOUNCE_CONDITION = Condition(_DEBOUNCE_LOCK)
+_DEBOUNCE_EPOCHS = itertools.count(1)
+_DEBOUNCE_THREAD: Thread | None = None
 _DEFAULT_DEBOUNCE_SECONDS = 60.0
 _MAX_BUFFERED_MESSAGES = 10
+# The debounce scheduler only hands the flush (classifier call, LLM reply) to this pool,
+# so the number of threads talking to Ollama stays bounded however many chats flush.
+# Their requests are in flight together, which the Ollama server batches when started
+# with OLLAMA_NUM_PARALLEL > 1; when WHATSAPP_CLASSIFIER_MODEL differs from the
+# generation model, OLLAMA_MAX_LOADED_MODELS must also let both stay loaded.
+_FLUSH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv("WHATSAPP_FLUSH_WORKERS", "8"))),
+    thread_name_prefix="whatsapp-flush",
+)
 _DEFAULT_CLASSIFIER_MODEL = "deepseek-r1:latest"
-_HISTORY_CACHE: Dict[str, bool] = {}
-_SEEN_MESSAGE_IDS: "OrderedDict[str, float]" = OrderedDict()
+# Whether WAHA has earlier messages for a chat id, as (stored_at, has_history).
+_HISTORY_CACHE: "OrderedDict[str, Tuple[float, bool]]" = OrderedDict()
+_HISTORY_CACHE_LOCK = Lock()
+_HISTORY_CACHE_MAX = 4096
+_HISTORY_CACHE_TTL_SECONDS = 600.0
+# Contact sources whose category was decided by the router, a human or handoff detection;
+# other allow_bot contacts are classified again.
+_SETTLED_CONTACT_SOURCES = frozenset(
+    {"llm_router", "dashboard_toggle", "handoff_detect", "manual_outbound"}
+)
+# Replies waiting out their typing delay, as (due, seq, chat_id, typing, payload, app)
+# heap entries drained by a single sender thread. _TYPING_LAST_DUE keeps a chat's replies
+# in the order they were queued.
+_TYPING_QUEUE: list = []
+_TYPING_CONDITION = Condition()
+_TYPING_LAST_DUE: Dict[str, float] = {}
+_TYPING_SEQ = itertools.count()
+_TYPING_THREAD: Thread | None = None
+# Messages fetched per history probe; both directions are picked out of this window.
+_HISTORY_SAMPLE_LIMIT = 4
+# Seen message ids in two generations: new ids go into the current set, which becomes
+# the previous one every half TTL (or when it fills up). An id is therefore remembered
+# for between half and one full TTL, without expiring entries one by one.
+_SEEN_MESSAGE_IDS: Set[str] = set()
+_SEEN_MESSAGE_IDS_PREVIOUS: Set[str] = set()
+_SEEN_MESSAGE_IDS_ROTATED_AT = 0.0
 _SEEN_MESSAGE_IDS_LOCK = Lock()
 _MAX_SEEN_MESSAGE_IDS = 2000
 _SEEN_MESSAGE_TTL_SECONDS = 300.0
+_HTTP_SESSION: requests.Session | None = None
+_HTTP_SESSION_LOCK = Lock()
+# Keep-alive connections held per WAHA host; sized above the worker count.
+_HTTP_POOL_SIZE = 16
+# Routing verdicts keyed by a digest of (model, contact note, normalized message);
+# repeated openers ("halo", "mau tanya harga") skip the classifier call. Values are
+# (stored_at, verdict).
+_ROUTING_CACHE: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_ROUTING_CACHE_LOCK = Lock()
+_ROUTING_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+_ROUTING_CACHE_MAX = 1024
+_ROUTING_CACHE_TTL_SECONDS = 3600.0
+_ROUTING_KEY_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_ROUTING_MAX_MESSAGE_CHARS = 800
+# JSON schema passed as Ollama's structured-output format for routing verdicts.
+_ROUTING_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "category": {
+            "type": "string",
+            "enum": ["customer_question", "academic_help", "internal_or_partner", "other"],
+        },
+        "allow_bot": {"type": "boolean"},
+        "reason": {"type": "string"},
+    },
+    "required": ["category", "allow_bot", "reason"],
+}
+# Classifier calls in progress, by routing cache key; identical messages arriving while
+# one is running share its output instead of calling the model again.
+_ROUTING_INFLIGHT: Dict[bytes, Future] = {}
+_ROUTING_INFLIGHT_LOCK = Lock()
+_ROUTING_INFLIGHT_WAIT_SECONDS = 30.0
+# Routing prompts from chats flushing within this window share one classifier call (at
+# most _ROUTING_BATCH_MAX prompts, answered as a JSON array); 0 disables batching.
+_ROUTING_BATCH_WINDOW_MS = float(os.getenv("WHATSAPP_CLASSIFIER_BATCH_WINDOW_MS", "0"))
+_ROUTING_BATCH_MAX = max(1, int(os.getenv("WHATSAPP_CLASSIFIER_BATCH_MAX", "8")))
+_ROUTING_BATCH_QUEUE: "Queue[Tuple[str, str, Future]]" = Queue()
+_ROUTING_BATCHER: Thread | None = None
+_ROUTING_BATCHER_LOCK = Lock()
+_ROUTING_BATCH_INSTRUCTION = (
+    "Berikut beberapa pesan dari chat yang BERBEDA. Klasifikasikan setiap pesan secara "
+    "terpisah dengan aturan yang sama.\n"
+    "Balas HANYA dengan array JSON berisi satu objek per pesan, urut sesuai nomor pesan:\n"
+    '[{"category":"...","allow_bot":true|false,"reason":"..."}, ...]'
+)
 
 
 def _is_duplicate_message_id(message_id: str) -> bool:
+    global _SEEN_MESSAGE_IDS, _SEEN_MESSAGE_IDS_PREVIOUS, _SEEN_MESSAGE_IDS_ROTATED_AT
     if not message_id:
         return False
     now = time.time()
-    cutoff = now - _SEEN_MESSAGE_TTL_SECONDS
     with _SEEN_MESSAGE_IDS_LOCK:
-        while _SEEN_MESSAGE_IDS:
-            first_id, ts = next(iter(_SEEN_MESSAGE_IDS.items()))
-            if ts >= cutoff:
-                break
-            _SEEN_MESSAGE_IDS.popitem(last=False)
+        if (
+            now - _SEEN_MESSAGE_IDS_ROTATED_AT >= _SEEN_MESSAGE_TTL_SECONDS / 2
+            or len(_SEEN_MESSAGE_IDS) >= _MAX_SEEN_MESSAGE_IDS // 2
+        ):
+            _SEEN_MESSAGE_IDS_PREVIOUS = _SEEN_MESSAGE_IDS
+            _SEEN_MESSAGE_IDS = set()
+            _SEEN_MESSAGE_IDS_ROTATED_AT = now
         if message_id in _SEEN_MESSAGE_IDS:
-            _SEEN_MESSAGE_IDS.move_to_end(message_id)
-            _SEEN_MESSAGE_IDS[message_id] = now
             return True
-        _SEEN_MESSAGE_IDS[message_id] = now
-        if len(_SEEN_MESSAGE_IDS) > _MAX_SEEN_MESSAGE_IDS:
-            _SEEN_MESSAGE_IDS.popitem(last=False)
-    return False
+        # Keep a repeated id alive into the next generation.
+        _SEEN_MESSAGE_IDS.add(message_id)
+        return message_id in _SEEN_MESSAGE_IDS_PREVIOUS
 
 _CLARIFYING_PROMPT = (
     "Halo 👋\nAnda telah terhubung dengan chatbot layanan pelanggan Optimaxx.\nAda yang bisa kami bantu terkait layanan atau pertanyaan Anda?"
@@ -213,8 +309,15 @@ _VAGUE_HONORIFICS = {
     "om",
     "tante",
 }
-
-from textwrap import dedent
+_VAGUE_TOKENS = frozenset(_VAGUE_GREETING_TOKENS | _VAGUE_HONORIFICS)
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_NON_DIGIT_RE = re.compile(r"\D")
+_NON_LETTER_RE = re.compile(r"[^a-z]")
+_WHITELIST_SPLIT_RE = re.compile(r"[,\s]+")
+_THINK_BLOCK_RE = re.compile(r"<think>.*?</think>", re.DOTALL)
+_CODE_FENCE_RE = re.compile(r"`{3}.*?`{3}", re.DOTALL)
+_MARKDOWN_BOLD_RE = re.compile(r"\*\*(.*?)\*\*")
+_VAGUE_ROUTING_REASON = "tidak ada opening signal (bukan pembuka / tidak jelas)"
 
 
 def log_http_response(response):
@@ -259,26 +362,15 @@ def _is_vague_greeting(message_body: str) -> bool:
     text = (message_body or "").strip().lower()
     if not text:
         return False
-    tokens = re.findall(r"[a-z0-9]+", text)
-    if not tokens:
-        return True
-    remaining = [
-        token
-        for token in tokens
-        if token not in _VAGUE_GREETING_TOKENS and token not in _VAGUE_HONORIFICS
-    ]
-    return not remaining
+    tokens = _TOKEN_RE.findall(text)
+    return _VAGUE_TOKENS.issuperset(tokens)
 
 
 def _is_vague_routing_reason(reason: str) -> bool:
     """
     Return True when the classifier reason indicates ambiguity or vagueness.
     """
-    text = (reason or "").strip().lower()
-    if not text:
-        return False
-    target = "tidak ada opening signal (bukan pembuka / tidak jelas)"
-    return text == target
+    return (reason or "").strip().lower() == _VAGUE_ROUTING_REASON
 
 
 def _extract_unix_timestamp(payload: Dict[str, Any]) -> float | None:
@@ -317,9 +409,17 @@ def _is_stale_message(payload: Dict[str, Any], max_age_seconds: int) -> bool:
 
 
 def _get_config_value(key: str, default: str | None = None) -> str | None:
-    value = current_app.config.get(key)
-    if value is None:
-        value = os.getenv(key)
+    # Config and environment are fixed once the app is created, so each key is resolved
+    # once per app; the WAHA helpers read several keys for every outgoing call.
+    app = current_app._get_current_object()
+    values = app.extensions.setdefault("whatsapp_config", {})
+    try:
+        value = values[key]
+    except KeyError:
+        value = app.config.get(key)
+        if value is None:
+            value = os.getenv(key)
+        values[key] = value
     return (value or default)
 
 
@@ -339,6 +439,31 @@ def _build_waha_headers() -> Dict[str, str]:
     return headers
 
 
+def _get_http_session() -> requests.Session:
+    """
+    Return the process-wide HTTP session so WAHA calls reuse pooled keep-alive
+    connections instead of opening a new one per request.
+    """
+    global _HTTP_SESSION
+    if _HTTP_SESSION is not None:
+        return _HTTP_SESSION
+    with _HTTP_SESSION_LOCK:
+        if _HTTP_SESSION is None:
+            session = requests.Session()
+            # Retry transient gateway errors; urllib3 only retries idempotent methods by
+            # default, so a sendText POST is never repeated.
+            retries = Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504))
+            adapter = HTTPAdapter(
+                pool_connections=_HTTP_POOL_SIZE,
+                pool_maxsize=_HTTP_POOL_SIZE,
+                max_retries=retries,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+
 def _extract_json_object(raw: str) -> Dict[str, Any] | None:
     """
     Parse a JSON object from raw LLM output.
@@ -347,22 +472,25 @@ def _extract_json_object(raw: str) -> Dict[str, Any] | None:
         return None
     raw = str(raw).strip()
     try:
-        return json.loads(raw)
-    except json.JSONDecodeError:
-        match = re.search(r"\{.*\}", raw, flags=re.DOTALL)
-        if match:
-            try:
-                return json.loads(match.group(0))
-            except json.JSONDecodeError:
-                return None
-    return None
+        return fast_json.loads(raw)
+    except fast_json.JSONDecodeError:
+        pass
+    # Fall back to the outermost {...} span, e.g. when the model wraps the JSON in prose.
+    start = raw.find("{")
+    end = raw.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        return fast_json.loads(raw[start : end + 1])
+    except fast_json.JSONDecodeError:
+        return None
 
 
 def _normalize_routing_category(raw: str) -> tuple[str, bool]:
     """
     Normalize classifier category into (contact_category, allow_bot_default).
     """
-    token = re.sub(r"[^a-z]", "", (raw or "").lower())
+    token = _NON_LETTER_RE.sub("", (raw or "").lower())
     mapping: Dict[str, tuple[str, bool]] = {
         "customerquestion": ("lead", True),
         "customer": ("lead", True),
@@ -396,6 +524,23 @@ def normalize_wa_id(raw: str) -> str:
     return value
 
 
+def _get_cached_chat_id(base_id: str) -> str | None:
+    with _CHAT_ID_CACHE_LOCK:
+        chat_id = _CHAT_ID_CACHE.get(base_id)
+        if chat_id is not None:
+            _CHAT_ID_CACHE.move_to_end(base_id)
+        return chat_id
+
+
+def _store_cached_chat_id(base_id: str, chat_id: str, *, replace: bool = True) -> None:
+    with _CHAT_ID_CACHE_LOCK:
+        if replace or base_id not in _CHAT_ID_CACHE:
+            _CHAT_ID_CACHE[base_id] = chat_id
+        _CHAT_ID_CACHE.move_to_end(base_id)
+        while len(_CHAT_ID_CACHE) > _CHAT_ID_CACHE_MAX:
+            _CHAT_ID_CACHE.popitem(last=False)
+
+
 def normalize_chat_id(raw: str) -> str:
     """
     Convert user-provided ids/numbers to WAHA chatId format.
@@ -409,11 +554,11 @@ def normalize_chat_id(raw: str) -> str:
     if "@" in chat_id:
         base = chat_id.split("@", 1)[0]
         if base:
-            _CHAT_ID_CACHE.setdefault(base, chat_id)
+            _store_cached_chat_id(base, chat_id, replace=False)
         return chat_id
     if "-" in chat_id:
         return f"{chat_id}@g.us"
-    digits = re.sub(r"\D", "", chat_id)
+    digits = _NON_DIGIT_RE.sub("", chat_id)
     base = digits or chat_id
     return f"{base}@c.us"
 
@@ -454,33 +599,61 @@ def _log_history_messages(chat_id: str, messages: list[dict]) -> None:
         logging.debug("Failed to log history messages for %s: %s", chat_id, exc)
 
 
-def _fetch_history_sample(chat_id: str, message_ts: float | None, from_me: bool) -> dict | None:
+def _fetch_history_samples(
+    chat_id: str, message_ts: float | None
+) -> Tuple[dict | None, dict | None]:
     """
-    Fetch at most one message from WAHA for this chat in the given direction.
+    Fetch the latest few messages for this chat from WAHA in one request and return the
+    newest inbound and newest outbound message that has a body or media.
     Applies timestamp filter when provided to avoid counting the current message.
     """
     url = f"{_get_waha_base_url()}/api/{_get_waha_session()}/chats/{chat_id}/messages"
     headers = _build_waha_headers()
     params = {
-        "limit": 1,
+        "limit": _HISTORY_SAMPLE_LIMIT,
         "downloadMedia": "false",
-        "filter.fromMe": "true" if from_me else "false",
     }
     if message_ts is not None:
         params["filter.timestamp.lte"] = int(max(0, message_ts - 1))
 
-    resp = requests.get(url, params=params, headers=headers, timeout=5)
+    resp = _get_http_session().get(url, params=params, headers=headers, timeout=5)
     resp.raise_for_status()
-    payload = resp.json()
-    if isinstance(payload, list) and payload:
-        msg = payload[0]
-        if isinstance(msg, dict):
+    payload = fast_json.loads(resp.content)
+    inbound_msg = None
+    outbound_msg = None
+    if isinstance(payload, list):
+        for msg in payload:
+            if not isinstance(msg, dict):
+                continue
             body = str(msg.get("body") or "").strip()
-            has_media = bool(msg.get("hasMedia"))
-            if not body and not has_media:
-                return None
-            return msg
-    return None
+            if not body and not msg.get("hasMedia"):
+                continue
+            if msg.get("fromMe"):
+                outbound_msg = outbound_msg or msg
+            else:
+                inbound_msg = inbound_msg or msg
+    return inbound_msg, outbound_msg
+
+
+def _get_cached_history(chat_id: str) -> bool | None:
+    with _HISTORY_CACHE_LOCK:
+        entry = _HISTORY_CACHE.get(chat_id)
+        if entry is None:
+            return None
+        stored_at, has_history = entry
+        if time.monotonic() - stored_at > _HISTORY_CACHE_TTL_SECONDS:
+            del _HISTORY_CACHE[chat_id]
+            return None
+        _HISTORY_CACHE.move_to_end(chat_id)
+        return has_history
+
+
+def _store_cached_history(chat_id: str, has_history: bool) -> None:
+    with _HISTORY_CACHE_LOCK:
+        _HISTORY_CACHE[chat_id] = (time.monotonic(), has_history)
+        _HISTORY_CACHE.move_to_end(chat_id)
+        while len(_HISTORY_CACHE) > _HISTORY_CACHE_MAX:
+            _HISTORY_CACHE.popitem(last=False)
 
 
 def _has_existing_history(
@@ -506,8 +679,8 @@ def _has_existing_history(
         return False
 
     for normalized in normalized_candidates:
-        cached = _HISTORY_CACHE.get(normalized)
-        if cached is not None and message_ts is None:
+        cached = _get_cached_history(normalized) if message_ts is None else None
+        if cached is not None:
             if cached:
                 logging.info("History found for %s (cache).", normalized)
             else:
@@ -517,13 +690,9 @@ def _has_existing_history(
         inbound_msg = None
         outbound_msg = None
         try:
-            inbound_msg = _fetch_history_sample(normalized, message_ts, from_me=False)
+            inbound_msg, outbound_msg = _fetch_history_samples(normalized, message_ts)
         except Exception as exc:
-            logging.debug("Inbound history check failed for %s: %s", normalized, exc)
-        try:
-            outbound_msg = _fetch_history_sample(normalized, message_ts, from_me=True)
-        except Exception as exc:
-            logging.debug("Outbound history check failed for %s: %s", normalized, exc)
+            logging.debug("History check failed for %s: %s", normalized, exc)
 
         history_messages = []
         if inbound_msg:
@@ -539,7 +708,7 @@ def _has_existing_history(
             logging.info("History not found for %s.", normalized)
 
         if message_ts is None:
-            _HISTORY_CACHE[normalized] = has_history
+            _store_cached_history(normalized, has_history)
         if has_history:
             return True
 
@@ -555,7 +724,7 @@ def _get_test_whitelist() -> set[str]:
     if not raw:
         return set()
     allowed: set[str] = set()
-    for token in re.split(r"[,\s]+", str(raw)):
+    for token in _WHITELIST_SPLIT_RE.split(str(raw)):
         wa = normalize_wa_id(token)
         if wa:
             allowed.add(wa)
@@ -577,14 +746,14 @@ def _lookup_chat_id_from_waha(base_id: str, candidates: list[str]) -> str | None
     url = f"{_get_waha_base_url()}/api/{_get_waha_session()}/chats/overview"
     headers = _build_waha_headers()
     try:
-        response = requests.get(
+        response = _get_http_session().get(
             url,
             params={"ids": candidates, "limit": len(candidates)},
             headers=headers,
             timeout=5,
         )
         response.raise_for_status()
-        payload = response.json()
+        payload = fast_json.loads(response.content)
         if isinstance(payload, list):
             for candidate in candidates:
                 if any(isinstance(item, dict) and item.get("id") == candidate for item in payload):
@@ -612,24 +781,24 @@ def _resolve_chat_id(recipient: str) -> str:
     if not base_id:
         return normalize_chat_id(chat_id)
 
-    cached = _CHAT_ID_CACHE.get(base_id)
+    cached = _get_cached_chat_id(base_id)
     if cached:
         return cached
 
     if "-" in base_id:
         candidates = [f"{base_id}@g.us"]
     else:
-        digits = re.sub(r"\D", "", base_id)
+        digits = _NON_DIGIT_RE.sub("", base_id)
         base = digits or base_id
         candidates = [f"{base}@c.us", f"{base}@lid"]
 
     resolved = _lookup_chat_id_from_waha(base_id, candidates)
     if resolved:
-        _CHAT_ID_CACHE[base_id] = resolved
+        _store_cached_chat_id(base_id, resolved)
         return resolved
 
     fallback = candidates[0] if candidates else normalize_chat_id(chat_id)
-    _CHAT_ID_CACHE[base_id] = fallback
+    _store_cached_chat_id(base_id, fallback)
     return fallback
 
 
@@ -641,22 +810,32 @@ def _cancel_debounce_buffer(key: str | None) -> None:
     if not key:
         return
     with _DEBOUNCE_LOCK:
-        state = _DEBOUNCE_BUFFERS.pop(key, None)
-    if not state:
-        return
-    timer = state.get("timer")
-    if isinstance(timer, Timer):
-        try:
-            timer.cancel()
-        except Exception:
-            logging.debug("Failed to cancel debounce timer for %s", key)
+        _DEBOUNCE_BUFFERS.pop(key, None)
 
 
-def _flush_debounced_messages(key: str, app) -> None:
+def _debounce_scheduler_loop() -> None:
+    with _DEBOUNCE_CONDITION:
+        while True:
+            if not _DEBOUNCE_HEAP:
+                _DEBOUNCE_CONDITION.wait()
+                continue
+            remaining = _DEBOUNCE_HEAP[0][0] - time.monotonic()
+            if remaining > 0:
+                _DEBOUNCE_CONDITION.wait(remaining)
+                continue
+            _, epoch, key = heapq.heappop(_DEBOUNCE_HEAP)
+            state = _DEBOUNCE_BUFFERS.get(key)
+            if state is not None and state.get("epoch") == epoch:
+                _FLUSH_EXECUTOR.submit(_flush_debounced_messages, key, state["app"], epoch)
+
+
+def _flush_debounced_messages(key: str, app, epoch: int | None = None) -> None:
     with _DEBOUNCE_LOCK:
-        state = _DEBOUNCE_BUFFERS.pop(key, None)
-    if not state:
-        return
+        state = _DEBOUNCE_BUFFERS.get(key)
+        # A message that arrived after this flush was scheduled restarted the window.
+        if state is None or (epoch is not None and state.get("epoch") != epoch):
+            return
+        del _DEBOUNCE_BUFFERS[key]
 
     messages = [str(m).strip() for m in state.get("messages") or [] if str(m).strip()]
     if not messages:
@@ -724,6 +903,7 @@ def _schedule_debounced_reply(
     message_id: str | None = None,
     contact_context: Dict[str, Any] | None = None,
 ) -> None:
+    global _DEBOUNCE_THREAD
     debounce_seconds = _get_debounce_window_seconds()
     if debounce_seconds <= 0:
         _reply_with_llm(chat_id, wa_id, message_body, message_id=message_id)
@@ -744,11 +924,8 @@ def _schedule_debounced_reply(
     needs_classification = bool(contact_context.get("needs_classification")) if contact_context else False
     contact = contact_context.get("contact") if isinstance(contact_context, dict) else None
 
-    with _DEBOUNCE_LOCK:
+    with _DEBOUNCE_CONDITION:
         state = _DEBOUNCE_BUFFERS.get(key, {"messages": [], "message_ids": []})
-        timer = state.get("timer")
-        if isinstance(timer, Timer):
-            timer.cancel()
 
         messages = state.get("messages") or []
         messages.append(message_body.strip())
@@ -766,12 +943,17 @@ def _schedule_debounced_reply(
         if contact is not None:
             state["contact"] = contact
 
-        timer = Timer(debounce_seconds, _flush_debounced_messages, args=(key, app))
-        timer.daemon = True
-        state["timer"] = timer
-
+        epoch = next(_DEBOUNCE_EPOCHS)
+        state["epoch"] = epoch
+        state["app"] = app
         _DEBOUNCE_BUFFERS[key] = state
-        timer.start()
+        heapq.heappush(_DEBOUNCE_HEAP, (time.monotonic() + debounce_seconds, epoch, key))
+        if _DEBOUNCE_THREAD is None:
+            _DEBOUNCE_THREAD = Thread(
+                target=_debounce_scheduler_loop, daemon=True, name="whatsapp-debounce"
+            )
+            _DEBOUNCE_THREAD.start()
+        _DEBOUNCE_CONDITION.notify()
 
 def get_text_message_input(recipient, text) -> Dict[str, Any]:
     chat_id = _resolve_chat_id(recipient)
@@ -829,11 +1011,11 @@ def send_message(payload: Dict[str, Any], *, endpoint: str = "sendText"):
     url = f"{base_url}/api/{endpoint_path}"
 
     try:
-        response = requests.post(
+        response = _get_http_session().post(
             url,
-            json=payload if isinstance(payload, dict) else {},
+            data=fast_json.dumps(payload if isinstance(payload, dict) else {}),
             headers=headers,
-            timeout=10,
+            timeout=(3, 15),
         )
         response.raise_for_status()
     except requests.Timeout:
@@ -856,23 +1038,66 @@ def send_message(payload: Dict[str, Any], *, endpoint: str = "sendText"):
     except (
         requests.RequestException
     ) as e:
-        logging.error(f"Request failed due to: {e}")
+        logging.error("Request failed due to: %s", e)
         return jsonify({"status": "error", "message": "Failed to send message"}), 500
     else:
         log_http_response(response)
     return response
 
 
-def _simulate_human_typing(chat_id: str, *, min_seconds: float = 5.0, max_seconds: float = 10.0) -> None:
+def _send_after_typing(
+    chat_id: str,
+    payload: Dict[str, Any],
+    *,
+    min_seconds: float = 5.0,
+    max_seconds: float = 10.0,
+) -> None:
     """
-    Send typing indicators with a short randomized delay to mimic a human reply cadence.
+    Show the typing indicator now and send payload after a short randomized delay to
+    mimic a human reply cadence. Returns immediately; the typing sender thread stops
+    the indicator and sends the message when it is due.
     """
-    delay = random.uniform(min_seconds, max_seconds)
-    start_typing(chat_id)
-    try:
-        time.sleep(delay)
-    finally:
-        stop_typing(chat_id)
+    global _TYPING_THREAD
+    # payload already carries the resolved session and chatId; reuse them for both
+    # typing calls instead of resolving the chat id again.
+    typing = {"session": payload.get("session"), "chatId": payload.get("chatId")}
+    send_message(typing, endpoint="startTyping")
+    app = current_app._get_current_object()
+    due = time.monotonic() + random.uniform(min_seconds, max_seconds)
+    with _TYPING_CONDITION:
+        due = max(due, _TYPING_LAST_DUE.get(chat_id, 0.0))
+        _TYPING_LAST_DUE[chat_id] = due
+        heapq.heappush(
+            _TYPING_QUEUE, (due, next(_TYPING_SEQ), chat_id, typing, payload, app)
+        )
+        if _TYPING_THREAD is None:
+            _TYPING_THREAD = Thread(target=_typing_sender_loop, daemon=True, name="whatsapp-typing")
+            _TYPING_THREAD.start()
+        _TYPING_CONDITION.notify()
+
+
+def _typing_sender_loop() -> None:
+    while True:
+        with _TYPING_CONDITION:
+            while True:
+                if not _TYPING_QUEUE:
+                    _TYPING_CONDITION.wait()
+                    continue
+                remaining = _TYPING_QUEUE[0][0] - time.monotonic()
+                if remaining <= 0:
+                    break
+                _TYPING_CONDITION.wait(remaining)
+            due, _, chat_id, typing, payload, app = heapq.heappop(_TYPING_QUEUE)
+            if _TYPING_LAST_DUE.get(chat_id) == due:
+                del _TYPING_LAST_DUE[chat_id]
+        try:
+            with app.app_context():
+                send_message(typing, endpoint="stopTyping")
+                result = send_message(payload)
+            if isinstance(result, tuple):
+                logging.error("Failed to deliver message to %s (status %s)", chat_id, result[1])
+        except Exception:
+            logging.exception("Failed to deliver message to %s", chat_id)
 
 
 def _send_clarification_prompt(
@@ -883,9 +1108,7 @@ def _send_clarification_prompt(
     """
     if message_id:
         send_message(get_read_receipt_payload(chat_id, message_id), endpoint="sendSeen")
-    payload = get_text_message_input(chat_id, _CLARIFYING_PROMPT)
-    _simulate_human_typing(chat_id)
-    send_message(payload)
+    _send_after_typing(chat_id, get_text_message_input(chat_id, _CLARIFYING_PROMPT))
 
 
 def _reply_with_llm(
@@ -901,9 +1124,276 @@ def _reply_with_llm(
         )
         return
     response = process_text_for_whatsapp(response)
-    data = get_text_message_input(chat_id, response)
-    _simulate_human_typing(chat_id)
-    send_message(data)
+    _send_after_typing(chat_id, get_text_message_input(chat_id, response))
+
+def _routing_cache_key(model: str, contact_note: str, text: str) -> bytes:
+    """Digest of the routing inputs; case, punctuation and whitespace are folded."""
+    normalized = " ".join(_ROUTING_KEY_PUNCTUATION_RE.sub("", text.lower()).split())
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (model, contact_note, normalized):
+        digest.update(part.encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.digest()
+
+
+def _get_cached_routing(key: bytes) -> Dict[str, Any] | None:
+    with _ROUTING_CACHE_LOCK:
+        entry = _ROUTING_CACHE.get(key)
+        if entry is None:
+            _ROUTING_CACHE_STATS["misses"] += 1
+            return None
+        stored_at, verdict = entry
+        if time.monotonic() - stored_at > _ROUTING_CACHE_TTL_SECONDS:
+            del _ROUTING_CACHE[key]
+            _ROUTING_CACHE_STATS["expirations"] += 1
+            _ROUTING_CACHE_STATS["misses"] += 1
+            return None
+        _ROUTING_CACHE.move_to_end(key)
+        _ROUTING_CACHE_STATS["hits"] += 1
+        return dict(verdict)
+
+
+def _store_cached_routing(key: bytes, verdict: Dict[str, Any]) -> None:
+    with _ROUTING_CACHE_LOCK:
+        _ROUTING_CACHE[key] = (time.monotonic(), dict(verdict))
+        _ROUTING_CACHE.move_to_end(key)
+        while len(_ROUTING_CACHE) > _ROUTING_CACHE_MAX:
+            _ROUTING_CACHE.popitem(last=False)
+            _ROUTING_CACHE_STATS["evictions"] += 1
+
+
+def routing_cache_stats() -> Dict[str, Any]:
+    """Counters and size of the routing verdict cache in this process."""
+    with _ROUTING_CACHE_LOCK:
+        stats: Dict[str, Any] = dict(_ROUTING_CACHE_STATS)
+        stats["size"] = len(_ROUTING_CACHE)
+    stats["max_size"] = _ROUTING_CACHE_MAX
+    stats["ttl_seconds"] = _ROUTING_CACHE_TTL_SECONDS
+    return stats
+
+
+def _extract_json_array(raw: str) -> List[Any] | None:
+    """
+    Parse a JSON array from raw LLM output, ignoring a leading <think> block.
+    """
+    if not raw:
+        return None
+    raw = str(raw).rsplit("</think>", 1)[-1].strip()
+    start = raw.find("[")
+    end = raw.rfind("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        parsed = fast_json.loads(raw[start : end + 1])
+    except fast_json.JSONDecodeError:
+        return None
+    return parsed if isinstance(parsed, list) else None
+
+
+def _call_routing_classifier(
+    model: str, user_prompt: str, *, schema: Dict[str, Any] = _ROUTING_SCHEMA
+) -> str:
+    # The static rules go first as the system message and only the user turn varies, so
+    # Ollama can reuse the cached prompt prefix; num_ctx matches the generation calls on
+    # the same model to avoid a reload between the two. The schema makes Ollama constrain
+    # decoding to a verdict object, so the reply parses on the first try.
+    stream = get_ollama_client().chat(
+        model=model,
+        messages=[
+            {"role": "system", "content": ROUTING_CLASSIFIER_PROMPT},
+            {"role": "user", "content": user_prompt},
+        ],
+        options={
+            "temperature": 0.1,
+            "num_ctx": DEFAULT_CLASSIFIER_NUM_CTX,
+            "top_p": 0.1,
+            "repeat_penalty": 1.05,
+        },
+        keep_alive=DEFAULT_OLLAMA_KEEP_ALIVE,
+        format=schema,
+        stream=True,
+    )
+    return _read_until_json_closes(stream)
+
+
+def _read_until_json_closes(stream) -> str:
+    """
+    Collect a streamed classifier reply and stop reading once the first JSON object or
+    array after any <think> block is complete, instead of waiting for trailing tokens.
+    """
+    text = ""
+    scan_from = 0
+    depth = 0
+    in_string = False
+    escaped = False
+    try:
+        for chunk in stream:
+            text += chunk.message.content or ""
+            if scan_from == 0:
+                head = text.lstrip()
+                if head.startswith("<think>") or "<think>".startswith(head):
+                    end = text.find("</think>")
+                    if end == -1:
+                        continue
+                    scan_from = end + len("</think>")
+            for index in range(scan_from, len(text)):
+                char = text[index]
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"' and depth:
+                    in_string = True
+                elif char in "{[":
+                    depth += 1
+                elif char in "}]" and depth:
+                    depth -= 1
+                    if not depth:
+                        return text[: index + 1]
+            scan_from = max(scan_from, len(text))
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    return text
+
+
+def _resolve_routing_batch(model: str, jobs: List[Tuple[str, Future]]) -> None:
+    """
+    Classify the prompts in jobs with one classifier call and settle their futures with
+    one JSON object each; falls back to a call per prompt when the reply does not parse.
+    """
+    verdicts: List[Any] | None = None
+    if len(jobs) > 1:
+        numbered = "\n\n".join(
+            f"Pesan {index}:\n{prompt}" for index, (prompt, _) in enumerate(jobs, start=1)
+        )
+        try:
+            raw = _call_routing_classifier(
+                model,
+                f"{_ROUTING_BATCH_INSTRUCTION}\n\n{numbered}",
+                schema={"type": "array", "items": _ROUTING_SCHEMA},
+            )
+            verdicts = _extract_json_array(raw)
+        except Exception as exc:
+            logging.warning("Batched routing classifier failed; retrying per message: %s", exc)
+        if verdicts is not None and (
+            len(verdicts) != len(jobs) or not all(isinstance(item, dict) for item in verdicts)
+        ):
+            logging.info("Batched routing classifier reply did not match; retrying per message.")
+            verdicts = None
+    for index, (prompt, future) in enumerate(jobs):
+        try:
+            if verdicts is None:
+                output = _call_routing_classifier(model, prompt)
+            else:
+                output = fast_json.dumps(verdicts[index]).decode("utf-8")
+        except Exception as exc:
+            future.set_exception(exc)
+            continue
+        future.set_result(output)
+
+
+def _routing_batcher_loop() -> None:
+    window = _ROUTING_BATCH_WINDOW_MS / 1000.0
+    while True:
+        jobs = [_ROUTING_BATCH_QUEUE.get()]
+        deadline = time.monotonic() + window
+        while len(jobs) < _ROUTING_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(_ROUTING_BATCH_QUEUE.get(timeout=remaining))
+            except Empty:
+                break
+        by_model: Dict[str, List[Tuple[str, Future]]] = {}
+        for model, prompt, future in jobs:
+            by_model.setdefault(model, []).append((prompt, future))
+        for model, model_jobs in by_model.items():
+            try:
+                _resolve_routing_batch(model, model_jobs)
+            except Exception as exc:
+                for _, future in model_jobs:
+                    if not future.done():
+                        future.set_exception(exc)
+
+
+def _ensure_routing_batcher() -> None:
+    global _ROUTING_BATCHER
+    if _ROUTING_BATCHER is not None:
+        return
+    with _ROUTING_BATCHER_LOCK:
+        if _ROUTING_BATCHER is not None:
+            return
+        _ROUTING_BATCHER = Thread(
+            target=_routing_batcher_loop, daemon=True, name="whatsapp-routing-batcher"
+        )
+        _ROUTING_BATCHER.start()
+
+
+def _request_routing_output(model: str, user_prompt: str) -> str:
+    """
+    Raw classifier reply for user_prompt, micro-batched with other chats' prompts when
+    WHATSAPP_CLASSIFIER_BATCH_WINDOW_MS is set.
+    """
+    if _ROUTING_BATCH_WINDOW_MS <= 0 or _ROUTING_BATCH_MAX <= 1:
+        return _call_routing_classifier(model, user_prompt)
+    future: Future = Future()
+    _ensure_routing_batcher()
+    _ROUTING_BATCH_QUEUE.put((model, user_prompt, future))
+    return future.result()
+
+
+def warm_routing_classifier(app) -> None:
+    """
+    Load the routing classifier model and evaluate ROUTING_CLASSIFIER_PROMPT once, so the
+    first new-contact message does not wait for a cold model load.
+    """
+    with app.app_context():
+        model = _get_classifier_model()
+    try:
+        get_ollama_client().chat(
+            model=model,
+            messages=[
+                {"role": "system", "content": ROUTING_CLASSIFIER_PROMPT},
+                {"role": "user", "content": "halo"},
+            ],
+            options={"num_ctx": DEFAULT_CLASSIFIER_NUM_CTX, "num_predict": 1},
+            keep_alive=DEFAULT_OLLAMA_KEEP_ALIVE,
+        )
+    except Exception as exc:
+        logging.warning("Failed to warm routing classifier %s: %s", model, exc)
+
+
+def _routing_classifier_output(key: bytes, model: str, user_prompt: str) -> str:
+    """
+    Raw classifier reply for user_prompt. Concurrent calls with the same key wait for the
+    first one and reuse its reply (or its exception).
+    """
+    with _ROUTING_INFLIGHT_LOCK:
+        pending = _ROUTING_INFLIGHT.get(key)
+        if pending is None:
+            flight: Future = Future()
+            _ROUTING_INFLIGHT[key] = flight
+    if pending is not None:
+        return pending.result(timeout=_ROUTING_INFLIGHT_WAIT_SECONDS)
+
+    try:
+        raw = _request_routing_output(model, user_prompt)
+    except Exception as exc:
+        flight.set_exception(exc)
+        raise
+    else:
+        flight.set_result(raw)
+        return raw
+    finally:
+        with _ROUTING_INFLIGHT_LOCK:
+            _ROUTING_INFLIGHT.pop(key, None)
+
 
 def _classify_message_for_routing(
     wa_id: str, message_body: str, contact: Dict[str, Any] | None = None
@@ -925,38 +1415,32 @@ def _classify_message_for_routing(
     if not text:
         result["reason"] = "empty_message"
         return result
+    # Whether a chat opens with an inquiry shows in its first lines; a long debounced
+    # buffer only adds prefill time.
+    text = text[:_ROUTING_MAX_MESSAGE_CHARS]
 
     contact_note = (
         f"kontak terdaftar (kategori={contact.get('category','')}, allow_bot={contact.get('allow_bot', True)})"
         if contact
         else "kontak baru/unknown"
     )
-    user_prompt = dedent(
-        f"""
-        Info kontak: {contact_note}
-        Pesan (gabungan):
-        ---
-        {text}
-        ---
-        """
-    ).strip()
+    user_prompt = f"Info kontak: {contact_note}\nPesan (gabungan):\n---\n{text}\n---"
 
     model = result["model"]
-    try:
-        resp = ollama.chat(
-            model=model,
-            messages=[
-                {"role": "system", "content": ROUTING_CLASSIFIER_PROMPT},
-                {"role": "user", "content": user_prompt},
-            ],
-            options={
-                "temperature": 0.1,
-                "num_ctx": 3000,
-                "top_p": 0.1,
-                "repeat_penalty": 1.05,
-            },
+    cache_key = _routing_cache_key(model, contact_note, text)
+    cached = _get_cached_routing(cache_key)
+    if cached is not None:
+        result.update(cached)
+        logging.info(
+            "Routing decision for %s (cached): category=%s allow_bot=%s reason=%s",
+            wa_id or "<unknown>",
+            result["category"],
+            result["allow_bot"],
+            result["reason"],
         )
-        raw = resp.message.content
+        return result
+    try:
+        raw = _routing_classifier_output(cache_key, model, user_prompt)
         logging.debug("Routing classifier raw output for %s: %s", wa_id or "<unknown>", raw)
     except Exception as exc:
         logging.warning("Routing classifier failed for %s: %s", wa_id, exc)
@@ -981,6 +1465,10 @@ def _classify_message_for_routing(
             "model": model,
         }
     )
+    # Only parsed LLM verdicts are cached; fallbacks above are retried next time.
+    _store_cached_routing(
+        cache_key, {"category": category, "allow_bot": allow_bot, "reason": reason}
+    )
     logging.info(
         "Routing decision for %s: category=%s allow_bot=%s reason=%s",
         wa_id or "<unknown>",
@@ -988,8 +1476,6 @@ def _classify_message_for_routing(
         allow_bot,
         reason,
     )
-
-    print(result)
     return result
 
 
@@ -1011,17 +1497,8 @@ def _persist_routing_decision(
         return None
 
 def _unique_contact_candidates(*values: str) -> list[str]:
-    seen: set[str] = set()
-    out: list[str] = []
-    for value in values:
-        if not value:
-            continue
-        raw = str(value).strip()
-        if not raw or raw in seen:
-            continue
-        seen.add(raw)
-        out.append(raw)
-    return out
+    # dict.fromkeys keeps the first occurrence of each id, in order.
+    return [raw for raw in dict.fromkeys(str(value).strip() for value in values if value) if raw]
 
 
 def _expand_contact_candidates(*values: str) -> list[str]:
@@ -1039,7 +1516,7 @@ def _expand_contact_candidates(*values: str) -> list[str]:
             base = raw[4:]
         elif "@" in raw:
             base = raw.split("@", 1)[0]
-        digits = re.sub(r"\D", "", base)
+        digits = _NON_DIGIT_RE.sub("", base)
         if digits and digits != base:
             # keep original base too; add a c.us variant when we can derive digits
             expanded.append(base)
@@ -1062,9 +1539,9 @@ def _resolve_lid_to_phone(lid: str) -> str | None:
     url = f"{_get_waha_base_url()}/api/{_get_waha_session()}/lids/{lid_value}"
     headers = _build_waha_headers()
     try:
-        resp = requests.get(url, headers=headers, timeout=5)
+        resp = _get_http_session().get(url, headers=headers, timeout=5)
         resp.raise_for_status()
-        payload = resp.json()
+        payload = fast_json.loads(resp.content)
     except Exception as exc:
         logging.debug("WAHA lid->phone lookup failed for %s: %s", lid_value, exc)
         return None
@@ -1082,15 +1559,15 @@ def _resolve_phone_to_lid(phone: str) -> str | None:
     raw = (phone or "").strip()
     if not raw:
         return None
-    digits = re.sub(r"\D", "", raw)
+    digits = _NON_DIGIT_RE.sub("", raw)
     if not digits:
         return None
     url = f"{_get_waha_base_url()}/api/{_get_waha_session()}/lids/pn/{digits}"
     headers = _build_waha_headers()
     try:
-        resp = requests.get(url, headers=headers, timeout=5)
+        resp = _get_http_session().get(url, headers=headers, timeout=5)
         resp.raise_for_status()
-        payload = resp.json()
+        payload = fast_json.loads(resp.content)
     except Exception as exc:
         logging.debug("WAHA phone->lid lookup failed for %s: %s", digits, exc)
         return None
@@ -1144,7 +1621,7 @@ def _expand_contact_candidates_with_waha(*values: str) -> list[str]:
                 continue
 
         if lowered.endswith("@c.us"):
-            digits = re.sub(r"\D", "", raw)
+            digits = _NON_DIGIT_RE.sub("", raw)
             if digits:
                 lid = _resolve_phone_to_lid(digits)
                 if lid:
@@ -1178,12 +1655,13 @@ def _apply_contact_policy(
     candidates = _unique_contact_candidates(*(contact_candidates or []), wa_id)
     contact = None
     created = False
+    try:
+        found = get_contacts_many(candidates)
+    except Exception:
+        logging.exception("Contact store lookup failed for %s", ", ".join(candidates))
+        found = {}
     for candidate in candidates:
-        try:
-            contact = get_contact(candidate)
-        except Exception:
-            logging.exception("Contact store lookup failed for %s", candidate)
-            contact = None
+        contact = found.get(candidate)
         if contact:
             break
 
@@ -1234,7 +1712,7 @@ def _apply_contact_policy(
     needs_classification = False
     if created or contact.get("category") == DEFAULT_UNKNOWN_CATEGORY:
         needs_classification = True
-    elif contact.get("allow_bot", True) and src not in {"llm_router", "dashboard_toggle", "handoff_detect", "manual_outbound"}:
+    elif contact.get("allow_bot", True) and src not in _SETTLED_CONTACT_SOURCES:
         needs_classification = True
 
     if not contact.get("allow_bot", True) and not needs_classification:
@@ -1276,11 +1754,13 @@ def process_whatsapp_message(body):
         logging.warning("Unable to parse WAHA webhook payload; skipping processing.")
         return
 
-    chat_id = normalize_chat_id(chat_id_raw or wa_id)
-
+    # Cheap rejections first: retried and replayed webhooks stop here before any chat id
+    # normalization.
     if _is_stale_message(waha_payload, _get_max_message_age_seconds()):
         logging.info(
-            "Ignoring old WhatsApp message %s for %s", message_id or "<no-id>", wa_id or chat_id
+            "Ignoring old WhatsApp message %s for %s",
+            message_id or "<no-id>",
+            wa_id or chat_id_raw,
         )
         return
 
@@ -1288,7 +1768,7 @@ def process_whatsapp_message(body):
         logging.info(
             "Skipping duplicate WhatsApp message %s for %s",
             message_id or "<no-id>",
-            wa_id or chat_id,
+            wa_id or chat_id_raw,
         )
         return
 
@@ -1300,6 +1780,8 @@ def process_whatsapp_message(body):
         logging.info("Skipping sender %s because they are not in WHATSAPP_TEST_NUMBERS.", wa_id)
         return
 
+    chat_id = normalize_chat_id(chat_id_raw or wa_id)
+
     if from_me:
         target_raw = to_raw or chat_id_raw or wa_id
         target_wa_id = normalize_wa_id(target_raw)
@@ -1329,9 +1811,8 @@ def process_whatsapp_message(body):
         return
 
     message_body = str(contact_decision.get("message_body") or "").strip()
-    logging.info(
-        "Processing WhatsApp message %s", message_body,
-    )
+    # Bodies can be long debounced pastes; the first 200 characters identify the message.
+    logging.info("Processing WhatsApp message %.200s", message_body)
 
     if has_media:
         logging.info(
@@ -1360,15 +1841,15 @@ def process_text_for_whatsapp(text):
     if not text:
         return ""
     
-    text = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL)
-    text = re.sub(r"`{3}.*?`{3}", "", text, flags=re.DOTALL)
+    text = _THINK_BLOCK_RE.sub("", text)
+    text = _CODE_FENCE_RE.sub("", text)
     text = text.strip()
 
     text = text.replace("#", "")
     text = text.replace("(https://optimaxx.id/id)", "")
     text = text.replace("kanal", "channel")
 
-    return re.sub(r"\*\*(.*?)\*\*", r"*\1*", text)
+    return _MARKDOWN_BOLD_RE.sub(r"*\1*", text)
 
 
 def extract_message_payload(body: Dict[str, Any]) -> Dict[str, Any] | None:
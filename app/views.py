@@ -1,8 +1,11 @@
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
 
-from flask import Blueprint, request, jsonify
-from werkzeug.exceptions import BadRequest
+from flask import Blueprint, current_app, request, jsonify
 
+from app.utils import fast_json
 from .utils.whatsapp_utils import (
     process_whatsapp_message,
     is_valid_whatsapp_message,
@@ -11,14 +14,21 @@ from app.services.whatsapp_queue import enqueue_whatsapp_job
 
 webhook_blueprint = Blueprint("webhook", __name__)
 
+# Used only when a payload cannot be queued; the semaphore caps running plus waiting jobs.
+_FALLBACK_EXECUTOR = ThreadPoolExecutor(
+    max_workers=max(1, int(os.getenv("WHATSAPP_FALLBACK_WORKERS", "4"))),
+    thread_name_prefix="whatsapp-fallback",
+)
+_FALLBACK_SLOTS = BoundedSemaphore(16)
+
 
 def handle_message():
     """
     Handle incoming WAHA webhook events (message/message.any) and enqueue for processing.
     """
     try:
-        body = request.get_json()
-    except BadRequest:
+        body = fast_json.loads(request.get_data(cache=False))
+    except ValueError:  # JSONDecodeError, or bytes that are not valid UTF-8
         logging.error("Failed to parse JSON payload", exc_info=True)
         return jsonify({"status": "error", "message": "Invalid JSON provided"}), 400
 
@@ -40,10 +50,31 @@ def handle_message():
         return jsonify({"status": "error", "message": "Invalid payload structure"}), 400
 
 
+def _process_in_app_context(app, body):
+    try:
+        with app.app_context():
+            process_whatsapp_message(body)
+    except Exception:
+        logging.exception("Failed to process WhatsApp payload outside the queue")
+    finally:
+        _FALLBACK_SLOTS.release()
+
+
 def _enqueue_whatsapp_processing(body):
     try:
         enqueue_whatsapp_job(body)
     except Exception:
+        # Process on a small pool so the webhook still answers right away; once the pool
+        # and its backlog are full, handle the payload inline as before.
+        if _FALLBACK_SLOTS.acquire(blocking=False):
+            logging.exception("Failed to enqueue WhatsApp payload; processing in background.")
+            try:
+                _FALLBACK_EXECUTOR.submit(
+                    _process_in_app_context, current_app._get_current_object(), body
+                )
+                return
+            except Exception:
+                _FALLBACK_SLOTS.release()
         logging.exception("Failed to enqueue WhatsApp payload; processing immediately.")
         process_whatsapp_message(body)
 